@@ -0,0 +1,140 @@
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from threading import Event
+
+import numpy as np
+from pyrope import Replay
+
+import plotter
+from analyser import Analyser, AnalyserUtils
+from replay_cache import ReplayCache
+
+logger = logging.getLogger('pyrain')
+
+STOP_POLL = 0.2  # Seconds between checks for a cancelled aggregation
+
+
+class HistogramAggregate:
+    """Binned positions of players and the ball summed over many replays.
+
+    Counts are kept as one fine histogram (see plotter.FINE_BINS) per arena and actor name, so
+    any resolution can be derived from them like for a single dataset. Replays are merged one at
+    a time and each match is only counted once.
+    """
+
+    def __init__(self):
+        self.grids = {}  # (arena name, actor name) -> fine histogram
+        self.replays = {}  # (arena name, actor name) -> number of merged replays
+        self.crcs = set()
+
+    def __len__(self):
+        return len(self.crcs)
+
+    def merge(self, result):
+        if result['crc'] in self.crcs:
+            return False
+        self.crcs.add(result['crc'])
+        for name, (bins, counts) in result['histograms'].items():
+            key = (result['arena'], name)
+            if key not in self.grids:
+                self.grids[key] = np.zeros((plotter.FINE_BINS[1], plotter.FINE_BINS[0]),
+                                           dtype=np.int64)
+                self.replays[key] = 0
+            self.grids[key].ravel()[bins] += counts
+            self.replays[key] += 1
+        return True
+
+
+def replay_histograms(path, cache=None):
+    """Bins the positions of every actor in the replay at path into sparse fine histograms.
+
+    Only the sparse result is cached by replay CRC, so aggregating many replays does not push
+    decoded replays out of the cache. Replays or analyser states that are already cached are
+    used instead of decoding again. Returns a dict with crc, arena name and actor name ->
+    (bin indices, counts).
+    """
+    cache = cache or ReplayCache()
+    replay = Replay(path=path)
+    result = cache.load(replay.crc, 'histograms')
+    if result is not None and result['bins'] == plotter.FINE_BINS:
+        return result
+    state = cache.load(replay.crc, 'analyser')
+    if state is not None:
+        analyser = Analyser(replay, state=state)
+    else:
+        decoded = cache.load(replay.crc)
+        if decoded is None:
+            _decode(replay)
+            decoded = replay
+        analyser = Analyser(decoded)
+
+    arena = plotter.WASTELAND if 'Wasteland' in replay.header['MapName'] else plotter.STANDARD
+    histograms = {}
+    for name in analyser.actor_names():
+        coords = analyser.get_actor_pos(name)
+        if not coords:
+            continue
+        # Binned chunk by chunk, so long replays do not need temporaries for all samples at once
+        fine = np.zeros(plotter.FINE_BINS[0] * plotter.FINE_BINS[1], dtype=np.int64)
+        for coord in coords:
+            for x, y, _ in AnalyserUtils.stream_coords(coord):
+                fine += np.bincount(plotter.bin_indices(x, y, arena), minlength=fine.size)
+        bins = np.flatnonzero(fine)
+        histograms[name] = (bins.astype(np.int32), fine[bins].astype(np.int32))
+    result = {'crc': replay.crc, 'arena': arena['name'], 'bins': plotter.FINE_BINS,
+              'histograms': histograms}
+    cache.store(replay.crc, result, 'histograms')
+    return result
+
+
+def process_replays(paths, stop=None, workers=None):
+    """Runs replay_histograms for all paths on a process pool.
+
+    Yields (path, result, exception) in order of completion so results can be merged as they
+    arrive. Once stop is set pending replays are cancelled and the generator returns without
+    waiting for the replays that are still being decoded. Those keep their worker busy until
+    they are done, and the interpreter waits for them on exit.
+    """
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers)
+    futures = {}
+    try:
+        futures = {executor.submit(replay_histograms, path): path for path in paths}
+        pending = set(futures)
+        while pending:
+            if stop is not None and stop.is_set():
+                return
+            done, pending = wait(pending, timeout=STOP_POLL, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning("Could not aggregate %s: %s" % (futures[future], e))
+                    yield futures[future], None, e
+                else:
+                    yield futures[future], result, None
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class _DiscardQueue:
+    # Stands in for the progress queue of Replay.parse_netstream and keeps the exception
+    def __init__(self):
+        self.exception = None
+        self._expect_exception = False
+
+    def put(self, msg):
+        if self._expect_exception:
+            self.exception = msg
+        elif msg == 'exception':
+            self._expect_exception = True
+
+
+def _decode(replay):
+    qout = _DiscardQueue()
+    replay.parse_netstream(qout, Event())
+    if qout.exception:
+        raise qout.exception
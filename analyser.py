@@ -1,115 +1,163 @@
+import logging
 import numpy as np
 from collections import OrderedDict
+from numpy.lib.stride_tricks import as_strided
+
+from cache import LRUCache
+from registry import ActorRegistry, PRI, CAR, BALL
+from trajectory import Trajectory
+
+logger = logging.getLogger('pyrain')
+
+POS_CACHE_SIZE = 64 * 2**20
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return sum(entry['data'].nbytes for entry in value)
 
 
 class Analyser:
-    def __init__(self, replay):
+    STATE = ('maxframe', 'frame_times', 'player_data', 'trajectories', 'registry')
+
+    def __init__(self, replay, cache_size=POS_CACHE_SIZE, state=None):
+        self.replay = replay
+        self.pos_cache = LRUCache(cache_size, sizeof=_nbytes)
+        if state is not None:
+            # Restore previously extracted data (see get_state) instead of walking the netstream
+            for attr in self.STATE:
+                setattr(self, attr, state[attr])
+            return
         if not replay.netstream:
             raise TypeError("Replay has to be decoded")
-        self.replay = replay
-        self.player_data = OrderedDict(sorted(self._get_player().items()))
+        self.maxframe = max(self.replay.netstream, key=int)
+        self.frame_times = np.full(self.maxframe + 1, np.nan)  # netstream time of each frame
+        self.player_data = OrderedDict()
+        self.trajectories = {}
+        self.registry = None
+        self._extract()
+
+    def get_state(self):
+        return {attr: getattr(self, attr) for attr in self.STATE}
 
     def get_actor_pos(self, name, sep=False):
-        if name == 'Ball':
-            pos = self._get_ball_pos(sep)
-        else:
-            pos = self._get_player_pos(name, sep)
-        return pos
+        # Returned entries are shared through the cache and must not be modified
+        key = (name, bool(sep))
+        result = self.pos_cache.get(key)
+        if result is not None:
+            logger.debug("Position cache hit for %s (%s)" % (name, self.pos_cache.stats()))
+            return result
+        result = []
+        for trajectory in self.trajectories[name]:
+            result.extend(self._wrap_data(name, trajectory, sep))
+        self.pos_cache.put(key, result)
+        logger.debug("Position cache miss for %s (%s)" % (name, self.pos_cache.stats()))
+        return result
 
-    def _get_player(self):
+    def _extract(self):
+        # Single pass over the netstream collecting players and all car/ball positions at once
         players = {}
-        maxframe = max(self.replay.netstream, key=int)
-        for i, frame in self.replay.netstream.items():
-            pri_ta = [value for name, value in frame.actors.items() if 'e_Default__PRI_TA' in name]
-            for value in pri_ta:
-                teamid = None
-                actorid = value['actor_id']
-                try:
-                    teamid = value['data']['Engine.PlayerReplicationInfo:Team'][1]
-                except KeyError: pass
-                try:
-                    playername = value['data']['Engine.PlayerReplicationInfo:PlayerName']
-                    if playername in players:  # Player already exists
-                        if not any(actorid in data[playername]['id']
-                                   for data in players[playername]):
-                            players[playername].append({'id': actorid,
-                                                        'join': i,
-                                                        'left': maxframe,
-                                                        'team': teamid})
-                    elif 'TAGame.PRI_TA:ClientLoadout' in value['data']:
-                        players[playername] = [{'id': actorid,
+        tracks = {}  # player name -> trajectories of all segments
+        open_tracks = {}  # PRI actor id -> trajectory of the players current segment
+        ball = self._new_track(self.maxframe)
+        registry = ActorRegistry()
+        for i in sorted(self.replay.netstream):
+            frame = self.replay.netstream[i]
+            self.frame_times[i] = frame.current
+            positions = {}
+            ball_pos = None
+            left = []
+            for key, value in frame.actors.items():
+                actorid, cls = registry.spawn(key, value)
+                data = value['data']
+                if cls == PRI:
+                    if self._update_player(players, tracks, open_tracks, value, i):
+                        left.append(actorid)
+                elif cls == CAR:
+                    if 'Engine.Pawn:PlayerReplicationInfo' in data:
+                        registry.set_owner(data['Engine.Pawn:PlayerReplicationInfo'][1], actorid)
+                    if 'TAGame.RBActor_TA:ReplicatedRBState' in data:
+                        positions[actorid] = data['TAGame.RBActor_TA:ReplicatedRBState']['pos']
+                elif cls == BALL:
+                    if 'TAGame.RBActor_TA:ReplicatedRBState' in data:
+                        ball_pos = data['TAGame.RBActor_TA:ReplicatedRBState']['pos']
+            self._append_pos(ball, i, ball_pos)
+            for actorid, track in open_tracks.items():
+                self._append_pos(track, i, positions.get(registry.owner(actorid)))
+            for actorid in left:
+                if actorid in open_tracks:
+                    open_tracks.pop(actorid)['end'] = i
+        # Frames missing from the netstream repeat the time of the frame before them, so the
+        # timeline stays sorted for searchsorted and never yields NaN start or end times
+        present = ~np.isnan(self.frame_times)
+        first = np.argmax(present)
+        filled = np.maximum.accumulate(np.where(present, np.arange(len(present)), first))
+        self.frame_times = self.frame_times[filled]
+        self.registry = registry
+        self.player_data = OrderedDict(sorted(players.items()))
+        self.trajectories = {name: [self._finalize_track(t) for t in tracks[name]
+                                    if t['frame']]
+                             for name in self.player_data}
+        self.trajectories['Ball'] = [self._finalize_track(ball)] if ball['frame'] else []
+
+    def _update_player(self, players, tracks, open_tracks, value, i):
+        teamid = None
+        actorid = value['actor_id']
+        try:
+            teamid = value['data']['Engine.PlayerReplicationInfo:Team'][1]
+        except KeyError: pass
+        try:
+            playername = value['data']['Engine.PlayerReplicationInfo:PlayerName']
+            if playername in players:  # Player already exists
+                if not any(actorid == data['id'] for data in players[playername]):
+                    players[playername].append({'id': actorid,
                                                 'join': i,
-                                                'left': maxframe,
-                                                'team': teamid}]
-                except KeyError:
-                    pass
-                if teamid == -1:
-                    for actors in players.values():
-                        for actor in actors:
-                            if actorid == actor['id']:
-                                actor['left'] = i
-        return players
-
-    def _get_player_pos(self, player, sep=False):
-        actors = self.player_data[player]
-        result = []
-        for actor in actors:
-            current_car = -1
-            car_actors = []
-            frame_left = max(self.replay.netstream, key=int)
-            player_spawned = False
-            frame_entered = 0
-            for i in range(actor['join'], actor['left']+1):
-                frame = self.replay.netstream[i]
-                found_pos = False
-                for f_actor in frame.actors.values():
-                    try:
-                        if f_actor['data']['Engine.Pawn:PlayerReplicationInfo'][1] == actor['id']:
-                            current_car = f_actor['actor_id']
-                    except KeyError:
-                        pass
-                    if f_actor['actor_id'] == current_car:
-                        try:
-                            pos = f_actor['data']['TAGame.RBActor_TA:ReplicatedRBState']['pos']
-                            car_actors.append(pos)
-                            found_pos = True
-                            if not player_spawned:
-                                player_spawned = True
-                                frame_entered = i
-                        except KeyError:
-                            pass
-                if not found_pos and player_spawned:
-                    car_actors.append(car_actors[-1])
-                try:
-                    actor_data = frame.actors[str(actor['id']) + 'e_Default__PRI_TA']['data']
-                    if actor_data['Engine.PlayerReplicationInfo:Team'][1] == -1:
-                        # Player got assigned team -1 that means he left the game early
-                        frame_left = i
-                        break
-                except KeyError:
-                    pass
-            result.extend(self._wrap_data(player, car_actors, frame_entered, frame_left, sep))
-        return result
+                                                'left': self.maxframe,
+                                                'team': teamid})
+                    open_tracks[actorid] = self._new_track(self.maxframe)
+                    tracks[playername].append(open_tracks[actorid])
+            elif 'TAGame.PRI_TA:ClientLoadout' in value['data']:
+                players[playername] = [{'id': actorid,
+                                        'join': i,
+                                        'left': self.maxframe,
+                                        'team': teamid}]
+                open_tracks[actorid] = self._new_track(self.maxframe)
+                tracks[playername] = [open_tracks[actorid]]
+        except KeyError:
+            pass
+        if teamid == -1:
+            # Player got assigned team -1 that means he left the game early
+            for actors in players.values():
+                for actor in actors:
+                    if actorid == actor['id']:
+                        actor['left'] = i
+            return True
+        return False
 
-    def _get_ball_pos(self, sep=False):
-        data = []
-        for num, frame in self.replay.netstream.items():
-            found_ball = False
-            for actor in frame.actors.values():
-                if "Ball_Default" in actor['actor_type']:
-                    try:
-                        pos = actor['data']['TAGame.RBActor_TA:ReplicatedRBState']['pos']
-                        data.append(pos)
-                        found_ball = True
-                    except KeyError:
-                        pass
-            if not found_ball and data:
-                data.append(data[-1])
-        result = self._wrap_data('Ball', data, 0, max(self.replay.netstream, key=int), sep)
-        return result
+    @staticmethod
+    def _new_track(end):
+        return {'frame': [], 'pos': [], 'end': end}
 
-    def _wrap_data(self, player, data, start, end, slicing=False):
+    @staticmethod
+    def _append_pos(track, framenum, pos):
+        # The rigid body state is only replicated when it changes, so a missing position means
+        # the actor is still where it was last seen
+        if pos is None:
+            if not track['pos']:
+                return
+            pos = track['pos'][-1]
+        track['frame'].append(framenum)
+        track['pos'].append(pos)
+
+    def _finalize_track(self, track):
+        times = self.frame_times[track['frame']]
+        return Trajectory.from_samples(track['frame'], times, track['pos'], track['end'])
+
+    def _wrap_data(self, player, data, slicing=False):
         result = []
+        start = data.start
+        end = data.end
         if slicing:
             slice_frames = [v['frame'] for v in self.replay.header['Goals'] if
                             start <= v['frame'] <= end]
@@ -117,53 +165,147 @@ class Analyser:
             lastframe = start
             for framenum in slice_frames:
                 result.append({'player': player,
-                               'start': self.replay.netstream[lastframe].current,
-                               'end': self.replay.netstream[framenum].current,
+                               'start': self.frame_times[lastframe],
+                               'end': self.frame_times[framenum],
                                'frame_start': lastframe,
                                'frame_end': framenum,
-                               'data': data[lastframe-start:framenum-start]})
+                               'data': data.slice_frames(lastframe, framenum)})
                 lastframe = framenum
         else:
             result.append({'player': player,
-                           'start': self.replay.netstream[start].current,
-                           'end': self.replay.netstream[end].current,
+                           'start': self.frame_times[start],
+                           'end': self.frame_times[end],
                            'frame_start': start,
                            'frame_end': end,
-                           'data': data[:-1]})
+                           'data': data.slice_frames(start, end)})
+        return result
+
+    def aligned_pos(self, name):
+        # Positions of all segments of an actor on the shared frame axis, NaN where absent.
+        # Segments end before their end frame like in get_actor_pos
+        key = ('aligned', name)
+        result = self.pos_cache.get(key)
+        if result is not None:
+            return result
+        result = np.full((self.maxframe + 1, 3), np.nan, dtype=np.float32)
+        for trajectory in self.trajectories[name]:
+            data = trajectory.slice_frames(trajectory.start, trajectory.end)
+            result[data.frame] = data.pos
+        self.pos_cache.put(key, result)
         return result
 
+    def position_tensor(self, step=1):
+        # (frames, actors, 3) positions of all players and the ball, actors ordered as actor_names
+        key = ('tensor', step)
+        result = self.pos_cache.get(key)
+        if result is not None:
+            return result
+        result = np.stack([self.aligned_pos(name)[::step] for name in self.actor_names()], axis=1)
+        self.pos_cache.put(key, result)
+        return result
+
+    def actor_names(self):
+        return list(self.player_data) + ['Ball']
+
+    def distance_matrix(self, step=1, condensed=False):
+        """Distances between all players and the ball for every step-th frame.
+
+        The result holds a (frames, actors, actors) float32 tensor, or (frames, pairs) in the
+        order of np.triu_indices if condensed. Frames in which either actor is absent are NaN.
+        """
+        pos = self.position_tensor(step)
+        first, second = np.triu_indices(pos.shape[1], 1)
+        diff = pos[:, first] - pos[:, second]
+        pairs = np.sqrt(np.einsum('fpk,fpk->fp', diff, diff))
+        if condensed:
+            distances = pairs
+        else:
+            distances = np.zeros((pos.shape[0], pos.shape[1], pos.shape[1]), dtype=np.float32)
+            distances[:, first, second] = pairs
+            distances[:, second, first] = pairs
+            diagonal = np.arange(pos.shape[1])
+            distances[:, diagonal, diagonal] = np.where(np.isnan(pos[:, :, 0]), np.nan, 0)
+        return {'actors': self.actor_names(),
+                'pairs': (first, second),
+                'time': self.frame_times[::step],
+                'distance': distances}
+
+    def overlaps(self):
+        # Actor name -> all other actors that are present in at least one common frame
+        names = self.actor_names()
+        present = (~np.isnan(self.position_tensor()[:, :, 0])).astype(np.int32)
+        common = present.T.dot(present) > 0
+        return {name: [other for j, other in enumerate(names) if j != i and common[i, j]]
+                for i, name in enumerate(names)}
+
+    def player_team(self, name):
+        # Team number (0/1) of a player or None if the team actor was never resolved
+        for segment in self.player_data[name]:
+            team = self.registry.team_number(segment['team'])
+            if team is not None:
+                return team
+        return None
+
+    def ball_chaser(self):
+        """Player closest to the ball in every frame, overall and per team.
+
+        closest and team_closest hold indices into players (-1 where nobody is present),
+        closest_time the accumulated seconds each player spent closest to the ball.
+        """
+        pos = self.position_tensor()
+        players = list(self.player_data)
+        delta = pos[:, :-1] - pos[:, -1:]
+        distances = np.sqrt(np.einsum('fpk,fpk->fp', delta, delta))
+        distances[np.isnan(distances)] = np.inf
+        closest = self._closest(distances)
+        durations = np.diff(self.frame_times)
+        durations = np.append(np.nan_to_num(durations), 0)
+        present = closest >= 0
+        closest_time = np.bincount(closest[present], weights=durations[present],
+                                   minlength=len(players))
+        teams = [self.player_team(name) for name in players]
+        team_closest = {}
+        for team in sorted(set(t for t in teams if t is not None)):
+            members = np.array([i for i, t in enumerate(teams) if t == team])
+            nearest = self._closest(distances[:, members])
+            team_closest[team] = np.where(nearest >= 0, members[nearest], -1).astype(np.int8)
+        total = closest_time.sum()
+        summary = [(name, teams[i], closest_time[i], closest_time[i] / total if total else 0)
+                   for i, name in enumerate(players)]
+        return {'players': players,
+                'time': self.frame_times,
+                'closest': closest,
+                'team_closest': team_closest,
+                'closest_time': closest_time,
+                'summary': sorted(summary, key=lambda row: row[2], reverse=True)}
+
+    @staticmethod
+    def _closest(distances):
+        if not distances.shape[1]:
+            return np.full(len(distances), -1, dtype=np.int8)
+        nearest = np.argmin(distances, axis=1).astype(np.int8)
+        nearest[np.isinf(distances.min(axis=1))] = -1
+        return nearest
+
     def calc_dist(self, player, reference=None):
-        data_p = self.get_actor_pos(player)
-        vec_p = np.array(data_p[0]['data'])  # TODO that only views single Player Ids (no rejoin?)
+        vec_p = self.aligned_pos(player)
         if reference:
-            data_r = self.get_actor_pos(reference)
-            start = max(data_p[0]['frame_start'], data_r[0]['frame_start'])
-            end = min(data_p[0]['frame_end'], data_r[0]['frame_end'])
-            delta = end - start
-            if delta <= 0:
-                raise ValueError('Actors do not Overlap')
-            pstart = start - data_p[0]['frame_start']
-            rstart = start - data_r[0]['frame_start']
-            pend = pstart + delta
-            rend = rstart + delta
-            vec_p = vec_p[pstart:pend]
-            vec_r = np.array(data_r[0]['data'][rstart:rend])
-            timeline = np.linspace(max(data_p[0]['start'], data_r[0]['start']),
-                                   min(data_p[0]['end'], data_r[0]['end']),
-                                   end - start)
-            distances = np.linalg.norm(vec_r - vec_p, axis=1)
-        else:
-            timeline = np.linspace(data_p[0]['start'], data_p[0]['end'],
-                                   data_p[0]['frame_end'] - data_p[0]['frame_start'])
-            distances = np.linalg.norm(vec_p, axis=1)
-        result = {'time': timeline,
-                  'distance': distances}
+            vec_p = self.aligned_pos(reference) - vec_p
+        distances = np.sqrt(np.einsum('ij,ij->i', vec_p, vec_p))
+        present = np.flatnonzero(~np.isnan(distances))
+        if not len(present):
+            raise ValueError('Actors do not Overlap')
+        start, end = present[0], present[-1] + 1
+        result = {'time': self.frame_times[start:end],
+                  'distance': distances[start:end],
+                  'mean': float(distances[present].mean())}
         return result
 
 
 class AnalyserUtils:
     @staticmethod
     def filter_coords(coords, x, y, z):
+        # x and y are swapped to match the orientation of the arena images
         result = []
         for coord in coords:
             player = coord['player']
@@ -173,15 +315,65 @@ class AnalyserUtils:
             title_short = "%s [%d - %d]" % (coord['player'], coord['start'], coord['end'])
             result.append({'title': title,
                            'title_short': title_short})
+            pos = AnalyserUtils._airborne(coord['data'].pos)
             if y:
-                y_coords = [x for x, y, z in coord['data'] if z > 0]
-                result[-1]['y'] = y_coords
+                result[-1]['y'] = pos[:, 0]
             if x:
-                x_coords = [y for x, y, z in coord['data'] if z > 0]
-                result[-1]['x'] = x_coords
+                result[-1]['x'] = pos[:, 1]
             if z:
-                z_coords = [z for x, y, z in coord['data'] if z > 0]
-                result[-1]['z'] = z_coords
-            if not len(x_coords) == len(y_coords):
-                raise ValueError('Wrong Dimensions')
+                result[-1]['z'] = pos[:, 2]
         return result
+
+    @staticmethod
+    def stream_coords(coord, chunk_size=2**16):
+        # Yields (x, y, z) column views chunk by chunk for datasets too long to filter at once
+        pos = coord['data'].pos
+        for start in range(0, len(pos), chunk_size):
+            chunk = AnalyserUtils._airborne(pos[start:start+chunk_size])
+            yield chunk[:, 1], chunk[:, 0], chunk[:, 2]
+
+    @staticmethod
+    def rolling_mean(values, window):
+        # Centered mean of window samples ignoring NaNs, O(n) through cumulative sums
+        valid = ~np.isnan(values)
+        sums = np.concatenate(([0], np.cumsum(np.where(valid, values, 0), dtype=np.float64)))
+        counts = np.concatenate(([0], np.cumsum(valid)))
+        index = np.arange(len(values))
+        lo = np.clip(index - window // 2, 0, len(values))
+        hi = np.clip(index + window - window // 2, 0, len(values))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums[hi] - sums[lo]) / (counts[hi] - counts[lo])
+
+    @staticmethod
+    def rolling_percentiles(values, window, percentiles, step=None):
+        """Percentiles of windows of window samples ignoring NaNs.
+
+        Windows are evaluated every step samples (window // 8 by default), which keeps the work
+        at O(n) for any window. Returns the center index of every window and an array with one
+        row per percentile.
+        """
+        window = max(1, min(window, len(values)))
+        step = step or max(1, window // 8)
+        values = np.asarray(values)
+        count = (len(values) - window) // step + 1
+        windows = as_strided(values, shape=(count, window),
+                             strides=(values.strides[0] * step, values.strides[0]))
+        windows = np.sort(windows, axis=1)  # Sorting copies the strided view, NaNs last
+        centers = np.arange(count) * step + window // 2
+        # Linear interpolation between the closest ranks like np.nanpercentile, for all windows
+        valid = window - np.isnan(windows).sum(axis=1)
+        rank = np.outer(np.asarray(percentiles) / 100, np.maximum(valid - 1, 0))
+        lo = np.floor(rank).astype(np.intp)
+        hi = np.minimum(lo + 1, np.maximum(valid - 1, 0))
+        rows = np.arange(count)
+        low = windows[rows, lo]
+        high = windows[rows, hi]
+        result = low + (high - low) * (rank - lo)
+        result[:, valid == 0] = np.nan
+        return centers, result
+
+    @staticmethod
+    def _airborne(pos):
+        # Drop samples with z <= 0, only copying when anything has to be dropped
+        mask = pos[:, 2] > 0
+        return pos if mask.all() else pos[mask]
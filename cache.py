@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache bounded by the summed size of its values in bytes."""
+
+    def __init__(self, max_bytes, sizeof=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof if sizeof else lambda value: getattr(value, 'nbytes', 0)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        try:
+            value, _ = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= evicted
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return "%d entries, %.1f/%.1f MB, %d hits, %d misses" % (
+            len(self._entries), self.size / 2**20, self.max_bytes / 2**20, self.hits, self.misses)
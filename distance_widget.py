@@ -1,16 +1,25 @@
 from PyQt5.QtGui import QBrush, QColor
 from PyQt5.QtWidgets import (QWidget, QHBoxLayout, QFrame, QListWidget, QAbstractItemView,
                              QPushButton, QGridLayout, QLabel, QComboBox, QSizePolicy,
-                             QSpacerItem, QGroupBox)
-from PyQt5.QtCore import QSize
+                             QSpacerItem, QGroupBox, QMessageBox, QSpinBox)
+from PyQt5.QtCore import QSize, QTimer
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
-import itertools
+
+import numpy as np
 
 import plotter
+from analyser import AnalyserUtils
+from cache import LRUCache
 from rangeslider import QRangeSlider
 
 WHITE = QBrush(QColor(255, 255, 255))
+REFRESH_INTERVAL = 16  # ms, range slider changes are applied at most once per display frame
+MEAN = 'Mean'
+ROLLING_MEAN = 'Rolling Mean'
+ROLLING_MEDIAN = 'Rolling Median'
+PERCENTILES = 'Median, 25-75%'
+STATS_CACHE_SIZE = 32 * 2**20
 
 
 class DistanceWidget(QWidget):
@@ -18,8 +27,15 @@ class DistanceWidget(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.plots = {}
+        self.plot_data = {}  # Full resolution time and distance of every plot
+        self.stat_data = {}  # Time and values of the statistic drawn with every shown plot
+        self.bands = {}  # Percentile bands of shown plots
+        self.stats = LRUCache(STATS_CACHE_SIZE, lambda value: sum(
+            getattr(array, 'nbytes', 0) for array in value))  # (plot, stat, window) -> stat
         self.overlaps = {}
         self.ax = None
+        self.background = None  # Canvas without the x axis and lines, see _cache_background
+        self.pending_xlim = {}  # Limits from the range slider waiting for the next refresh
         self.analyser = None
         self._generate_widget()
         self.setEnabled(False)
@@ -27,10 +43,16 @@ class DistanceWidget(QWidget):
     def set_analyser(self, analyser):
         # Reset Internal Variables and remove plots
         self.plots = {}
+        self.plot_data = {}
+        self.stat_data = {}
+        self.stats.clear()
         self.overlaps = {}
         self.lst_plots.clear()
         while self.ax.lines:
             self.ax.lines[-1].remove()
+        for band in self.bands.values():
+            band.remove()
+        self.bands = {}
         self.ax.relim()
         self.canvas.setVisible(False)
         self.range.setMin(500)
@@ -39,28 +61,18 @@ class DistanceWidget(QWidget):
         self.range.setVisible(False)
         # Populate GUI
         self.analyser = analyser
-        players = list(self.analyser.player_data.keys())
-        self.overlaps = {player: [] for player in players}
-        self.overlaps['Ball'] = players
-        for pair in itertools.permutations(players, 2):
-            if self._overlap(self.analyser.player_data[pair[0]],
-                             self.analyser.player_data[pair[1]]):
-                self.overlaps[pair[0]].append(pair[1])
-        [x.extend(['Ball', '(0,0,0)']) for x in self.overlaps.values()]
+        if analyser is None:
+            self.cmb_player.clear()
+            self.cmb_ref.clear()
+            self.setEnabled(False)
+            return
+        self.overlaps = self.analyser.overlaps()
+        [x.append('(0,0,0)') for x in self.overlaps.values()]
         self.cmb_player.clear()
         self.cmb_player.insertItems(0, [k for k in analyser.player_data])
         self.cmb_player.addItem('Ball')
         self.setEnabled(True)
 
-    def _overlap(self, player, reference):
-        for actor in player:
-            seperate = any(actor['join'] > cdata['left'] or
-                           cdata['join'] > actor['left']
-                           for cdata in reference)
-            if seperate:
-                return False
-        return True
-
     def _update_ref(self, text):
         if text:
             self.cmb_ref.clear()
@@ -79,7 +91,10 @@ class DistanceWidget(QWidget):
         self.ax = fig.add_subplot(111)
         plotter.set_colormap(self.ax)
         self.ax.hold(True)
+        # Only the x axis and the lines change while panning, they are blitted over the rest
+        self.ax.xaxis.set_animated(True)
         self.canvas = FigureCanvas(fig)
+        self.canvas.mpl_connect('draw_event', self._cache_background)
         self.canvas.setVisible(False)
         plot_layout.addWidget(self.canvas)
         layout_main.addWidget(frm_plot, 0, 1, 1, 1)
@@ -103,6 +118,11 @@ class DistanceWidget(QWidget):
         self.range.setVisible(False)
         layout_main.addWidget(self.range, 1, 1, 1, 1)
 
+        self.range_timer = QTimer(self)
+        self.range_timer.setSingleShot(True)
+        self.range_timer.setInterval(REFRESH_INTERVAL)
+        self.range_timer.timeout.connect(self._apply_xlim)
+
     def _setup_controls(self):
         groupbox = QGroupBox(self)
         size_policy = QSizePolicy(QSizePolicy.Ignored, QSizePolicy.MinimumExpanding)
@@ -156,6 +176,11 @@ class DistanceWidget(QWidget):
         btn_add.setText('Add Plot')
         grid.addWidget(btn_add, 3, 0, 1, 2)
         btn_add.clicked.connect(self._add_plot)
+
+        btn_chaser = QPushButton(frame)
+        btn_chaser.setText('Ball Chaser')
+        grid.addWidget(btn_chaser, 4, 0, 1, 2)
+        btn_chaser.clicked.connect(self._show_ball_chaser)
         return frame
 
     def _setup_plotctrl(self, parent):
@@ -185,8 +210,26 @@ class DistanceWidget(QWidget):
         grid.addWidget(btn_hide, 1, 1, 1, 1)
         btn_hide.clicked.connect(self._hide_plot)
 
+        lbl_stat = QLabel(frame)
+        lbl_stat.setText('Statistic:')
+        grid.addWidget(lbl_stat, 2, 0, 1, 1)
+        self.cmb_stat = QComboBox(frame)
+        self.cmb_stat.insertItems(0, [MEAN, ROLLING_MEAN, ROLLING_MEDIAN, PERCENTILES])
+        grid.addWidget(self.cmb_stat, 2, 1, 1, 1)
+        self.cmb_stat.currentIndexChanged.connect(self._stats_changed)
+
+        lbl_window = QLabel(frame)
+        lbl_window.setText('Window:')
+        grid.addWidget(lbl_window, 3, 0, 1, 1)
+        self.spn_window = QSpinBox(frame)
+        self.spn_window.setRange(2, 600)
+        self.spn_window.setValue(30)
+        self.spn_window.setSuffix(' s')
+        grid.addWidget(self.spn_window, 3, 1, 1, 1)
+        self.spn_window.valueChanged.connect(self._stats_changed)
+
         spacer = QSpacerItem(20, 0, QSizePolicy.Minimum, QSizePolicy.Expanding)
-        grid.addItem(spacer, 2, 0, 1, 2)
+        grid.addItem(spacer, 4, 0, 1, 2)
 
         self.buttons = {'show': btn_show,
                         'hide': btn_hide}
@@ -200,13 +243,24 @@ class DistanceWidget(QWidget):
         if label1 not in self.plots and label2 not in self.plots: # create new lineplot
             reference = None if reference == '(0,0,0)' else reference
             dot = self.analyser.calc_dist(player, reference)
-            lines = plotter.lines2d(dot['time'], dot['distance'], self.ax)
-            [line.remove() for line in lines]
+            lines = plotter.lines2d(dot['time'], dot['distance'], self.ax,
+                                    columns=self._columns())
+            for line in lines:
+                line.remove()
+                line.set_animated(True)
             self.plots[label1] = lines
+            self.plot_data[label1] = (dot['time'], dot['distance'])
             self.lst_plots.addItem(label1)
             item = self.lst_plots.item(self.lst_plots.count()-1)
             item.setBackground(WHITE)
-            item.setToolTip('Average Distance: '+str(int(lines[1].get_ydata()[0])))
+            item.setToolTip('Average Distance: '+str(int(dot['mean'])))
+
+    def _show_ball_chaser(self):
+        chaser = self.analyser.ball_chaser()
+        rows = ["%s (Team %s): %ds closest to the ball (%d%%)" %
+                (name, '?' if team is None else team, seconds, share*100)
+                for name, team, seconds, share in chaser['summary']]
+        QMessageBox.information(self, 'Ball Chaser', '\n'.join(rows) or 'No players found')
 
     def _show_plot(self):
         self.canvas.setVisible(True)
@@ -218,8 +272,12 @@ class DistanceWidget(QWidget):
                     self.ax.lines.append(plot)
             color = plotter.get_rgb(self.plots[item.text()][0])
             item.setBackground(QBrush(QColor(color)))
-        self.canvas.draw()
+        # Autoscaling needs the lines to cover the whole replay again
+        self._update_stats()
+        self._decimate()
+        # Layout first, the blit background is captured by the draw
         self.canvas.figure.tight_layout()
+        self.canvas.draw()
         self._update_range()
         self._toggle_buttons()
 
@@ -228,9 +286,11 @@ class DistanceWidget(QWidget):
             for plot in self.plots[item.text()]:
                 if plot in self.ax.lines:
                     plot.remove()
+            if item.text() in self.bands:
+                self.bands.pop(item.text()).remove()
             item.setBackground(WHITE)
-        self.canvas.draw()
         self.canvas.figure.tight_layout()
+        self.canvas.draw()
         self._toggle_buttons()
 
     def _toggle_buttons(self):
@@ -252,13 +312,91 @@ class DistanceWidget(QWidget):
             self._hide_plot()
 
     def _set_xmin(self, val):
-        self.ax.set_xlim(left=val)
-        self.canvas.draw()
+        self.pending_xlim['left'] = val
+        if not self.range_timer.isActive():
+            self.range_timer.start()
 
     def _set_xmax(self, val):
-        self.ax.set_xlim(right=val)
+        self.pending_xlim['right'] = val
+        if not self.range_timer.isActive():
+            self.range_timer.start()
+
+    def _apply_xlim(self):
+        self.ax.set_xlim(**self.pending_xlim)
+        self.pending_xlim = {}
+        self._decimate(self.ax.get_xlim())
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self._draw_animated()
+        self.canvas.blit(self.canvas.figure.bbox)
+
+    def _stats_changed(self):
+        if not any(lines[0] in self.ax.lines for lines in self.plots.values()):
+            return
+        self._update_stats()
+        self._decimate(self.ax.get_xlim())
         self.canvas.draw()
 
+    def _update_stats(self):
+        # The second line of every shown plot draws the selected statistic
+        stat = self.cmb_stat.currentText()
+        for label in self.plot_data:
+            line, stat_line = self.plots[label]
+            if label in self.bands:
+                self.bands.pop(label).remove()
+            if line not in self.ax.lines:
+                continue
+            stat_time, stat_values, band = self._statistic(label, stat, self.spn_window.value())
+            self.stat_data[label] = (stat_time, stat_values)
+            if band is not None:
+                self.bands[label] = self.ax.fill_between(stat_time, band[0], band[1], alpha=0.2,
+                                                         color=line.get_color(), linewidth=0)
+                self.bands[label].set_animated(True)
+
+    def _statistic(self, label, stat, seconds):
+        key = (label, stat, seconds)
+        result = self.stats.get(key)
+        if result is None:
+            time, distance = self.plot_data[label]
+            duration = time[-1] - time[0] if len(time) > 1 else 0
+            window = int(round(seconds * (len(time) - 1) / duration)) if duration > 0 else 1
+            if stat == ROLLING_MEAN:
+                result = (time, AnalyserUtils.rolling_mean(distance, window), None)
+            elif stat in (ROLLING_MEDIAN, PERCENTILES):
+                centers, bands = AnalyserUtils.rolling_percentiles(distance, window, (50, 25, 75))
+                result = (time[centers], bands[0], bands[1:] if stat == PERCENTILES else None)
+            else:
+                result = (time[[0, -1]], np.repeat(np.nanmean(distance), 2), None)
+            self.stats.put(key, result)
+        return result
+
+    def _columns(self):
+        return max(int(self.ax.bbox.width), 100)
+
+    def _decimate(self, xlim=None):
+        # Shown lines keep about two points per pixel column of the visible range
+        columns = self._columns()
+        for label, (time, distance) in self.plot_data.items():
+            line, stat_line = self.plots[label]
+            if line in self.ax.lines:
+                line.set_data(*plotter.decimate(time, distance, columns, xlim))
+                if label in self.stat_data:
+                    stat_line.set_data(*plotter.decimate(*self.stat_data[label], columns, xlim))
+
+    def _cache_background(self, event):
+        # Full draws leave out the animated artists, they are drawn on top of the copy
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        self.ax.draw_artist(self.ax.xaxis)
+        for band in self.bands.values():
+            self.ax.draw_artist(band)
+        for line in self.ax.lines:
+            self.ax.draw_artist(line)
+
     def _update_range(self):
         xlim = self.ax.get_xlim()
         xlim = [int(xlim[0]), int(xlim[1])]
@@ -1,18 +1,29 @@
 from os import path
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Event, Lock
 import math
 import logging
 
-from PyQt5.QtGui import QPalette, QColor
+from PyQt5.QtGui import QPalette, QColor, QImage, QPainter
 from PyQt5.QtWidgets import (QGridLayout, QSizePolicy, QScrollArea, QWidget, QLabel, QComboBox,
                              QPushButton, QGroupBox, QSpacerItem, QListWidget, QAbstractItemView,
                              QFrame, QSlider, QCheckBox, QDialog, QVBoxLayout, QFileDialog)
-from PyQt5.QtCore import Qt, QSize
+from PyQt5.QtCore import Qt, QSize, QRect, QObject, pyqtSignal
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+import numpy as np
 
 from qt_ext import FlowLayout
 from analyser import AnalyserUtils
+from cache import LRUCache
 import plotter
 
+HISTOGRAM_CACHE_SIZE = 64 * 2**20
+RENDER_WORKERS = 4
+
+_overlay_images = {}  # (arena name, overlays) -> QImage of the composited overlays
+
 
 class HeatmapWidget(QWidget):
 
@@ -21,7 +32,16 @@ class HeatmapWidget(QWidget):
         self.setEnabled(False)
         self.logger = logging.getLogger('pyrain')
         self.datasets = {}
+        self.aggregates = {}  # Datasets summed over many replays, see set_aggregate
         self.drawn_plots = {}
+        self.heatmaps = {}  # Dataset -> image widget of drawn histograms, see _resize_bins
+        self.histograms = LRUCache(HISTOGRAM_CACHE_SIZE)  # (dataset, arena, bins) -> histogram
+        self.histogram_lock = Lock()  # Histograms are binned on the render pool as well
+        self.histogram_generation = 0  # Bumped on every clear so late results are dropped
+        self.jobs = {}  # Dataset -> (future, stop event, settings, thumbnail) of pending plots
+        self.executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS)
+        self.emitter = RenderEmitter()
+        self.emitter.finished.connect(self._plot_finished)
         self.scroll_area = None  # Scrollarea with figures
         self.flowlayout = None  # FLowlayout containing figures
         self.cmb_player = None  # Player Selection for data extraction
@@ -32,28 +52,58 @@ class HeatmapWidget(QWidget):
         self.btn_updateplot = None
         self.cmb_style = None  # Plot style
         self.chk_logscale = None  # Scale Logarithmic
+        self.chk_thumbnails = None  # Draw histograms as images instead of figures
         self.sld_res = None  # Bin Scaling for plots
         self.analyser = None
         self._generate_widget()
 
     def set_analyser(self, analyser):
+        # None only removes the datasets of the previous replay, aggregated datasets are kept
         self.analyser = analyser
-        self.frm_extraction.setEnabled(True)
+        self.frm_extraction.setEnabled(analyser is not None)
         self.cmb_player.clear()
-        self.cmb_player.insertItems(0, [k for k in self.analyser.player_data.keys()])
-        self.cmb_player.addItem('Ball')
+        if analyser is not None:
+            self.cmb_player.insertItems(0, [k for k in self.analyser.player_data.keys()])
+            self.cmb_player.addItem('Ball')
 
         self._clear_plots()
         self.lst_plots.clear()
-        self.frm_settings.setEnabled(True)
-        self.frm_plots.setEnabled(True)
+        self.frm_settings.setEnabled(analyser is not None or bool(self.aggregates))
+        self.frm_plots.setEnabled(analyser is not None or bool(self.aggregates))
         self.btn_addplot.setEnabled(False)
         self.btn_removeplot.setEnabled(False)
         self.btn_updateplot.setEnabled(False)
         self.datasets = {}
         self.drawn_plots = {}
+        self.heatmaps = {}
+        self._clear_histograms()
+        self._add_datasets(self.aggregates.values())
+        self.setEnabled(True)
+
+    def set_aggregate(self, aggregate):
+        # Aggregated datasets only have histograms and are kept when another replay is loaded
+        for (arena_name, name), grid in aggregate.grids.items():
+            replays = aggregate.replays[(arena_name, name)]
+            title_short = '%s [All Replays, %s]' % (name, arena_name.title())
+            self.aggregates[title_short] = {'title': '%s in %d Replays' % (name, replays),
+                                            'title_short': title_short,
+                                            'fine': grid,
+                                            'arena': plotter.ARENAS[arena_name],
+                                            'x': np.empty(0),
+                                            'y': np.empty(0)}
+        # Grids grow in place while merging, so histograms derived from them are stale
+        self._clear_histograms()
+        self._add_datasets(self.aggregates.values())
+        self.frm_settings.setEnabled(True)
+        self.frm_plots.setEnabled(True)
         self.setEnabled(True)
 
+    def _add_datasets(self, datasets):
+        for entry in datasets:
+            if entry['title_short'] not in self.datasets:
+                self.lst_plots.addItem(entry['title_short'])
+            self.datasets[entry['title_short']] = entry
+
     def _generate_widget(self):
         size_policy = QSizePolicy(QSizePolicy.Preferred, QSizePolicy.Ignored)
         self.setSizePolicy(size_policy)
@@ -72,7 +122,8 @@ class HeatmapWidget(QWidget):
         scrollarea_content = QWidget()
         self.flowlayout = FlowLayout(scrollarea_content,
                                      container=self.scroll_area,
-                                     resize_threshold=(-20, -10))
+                                     resize_threshold=(-20, -10),
+                                     deferred=True)
         self.scroll_area.setWidget(scrollarea_content)
         grid.addWidget(self.scroll_area, 0, 1, 1, 1)
 
@@ -163,6 +214,13 @@ class HeatmapWidget(QWidget):
         self.chk_logscale.setText('Logarithmic Scaling')
         grid.addWidget(self.chk_logscale, 1, 0, 1, 4)
 
+        self.chk_thumbnails = QCheckBox(frame)
+        self.chk_thumbnails.setText('Thumbnails')
+        self.chk_thumbnails.setToolTip('Draw histograms as plain images, figures are only built '
+                                       'for Popout and Save')
+        self.chk_thumbnails.setChecked(True)
+        grid.addWidget(self.chk_thumbnails, 4, 0, 1, 4)
+
         lbl_res = QLabel(frame)
         lbl_res.setText('Resolution:')
         grid.addWidget(lbl_res, 2, 0, 1, 4)
@@ -174,6 +232,8 @@ class HeatmapWidget(QWidget):
         self.sld_res.setValue(10)
         grid.addWidget(self.sld_res, 3, 0, 1, 4)
 
+        self.sld_res.valueChanged.connect(self._resize_bins)
+
         return frame
 
     def _setup_plots(self, parent):
@@ -255,16 +315,17 @@ class HeatmapWidget(QWidget):
             if entry['title_short'] in self.datasets:
                 self.logger.debug("Dataset already in Plotlist")
                 continue
-            self.lst_plots.addItem(entry['title_short'])
-            self.datasets[entry['title_short']] = entry
+            self._add_datasets([entry])
 
     def _clear_plots(self):
         count = self.lst_plots.count()
         for i in range(count):
             item_name = self.lst_plots.item(i).text()
+            self._cancel_job(item_name)
             if item_name in self.drawn_plots:
                 self.drawn_plots[item_name].deleteLater()
                 del self.drawn_plots[item_name]
+                self.heatmaps.pop(item_name, None)
 
     def _remove_plots(self):
         items = self.lst_plots.selectedItems()
@@ -272,9 +333,11 @@ class HeatmapWidget(QWidget):
             return
         items_text = [item.text() for item in items]
         for item in items_text:
+            self._cancel_job(item)
             if item in self.drawn_plots:
                 self.drawn_plots[item].deleteLater()
                 del self.drawn_plots[item]
+                self.heatmaps.pop(item, None)
         self._highlight_plots()
 
     def _update_plots(self):
@@ -308,10 +371,13 @@ class HeatmapWidget(QWidget):
         items = self.lst_plots.selectedItems()
         if not items:
             return
-        items_text = [item.text() for item in items if item.text() in self.drawn_plots]
+        items_text = [item.text() for item in items
+                      if item.text() in self.drawn_plots and item.text() not in self.jobs]
         self.popouts = []  # Reference so the dialogs wont get garbage collected
         for plot in items_text:
-            figure = self.drawn_plots[plot].findChild(FigureCanvas).figure
+            figure = self._figure(plot)
+            if figure is None:
+                continue
             popout = PopoutDialog(FigureCanvas(figure), plot)
             popout.show()
             self.popouts.append(popout)
@@ -320,35 +386,95 @@ class HeatmapWidget(QWidget):
         items = self.lst_plots.selectedItems()
         if not items:
             return
-        items_text = [item.text() for item in items if item.text() in self.drawn_plots]
+        items_text = [item.text() for item in items
+                      if item.text() in self.drawn_plots and item.text() not in self.jobs]
         for plot in items_text:
             folder = path.dirname(path.realpath(__file__))
             ext = 'Plot (*.png)'
             filename = QFileDialog.getSaveFileName(self, 'Save Image', folder, ext)
-            if filename[0]:
-                fig = self.drawn_plots[plot].findChild(FigureCanvas).figure
+            fig = self._figure(plot)
+            if filename[0] and fig:
                 fig.savefig(filename[0])
 
-    def _generate_plot_widget(self, datasetname):
-        plt_type = self.cmb_style.currentText()
-        hexbin = True if plt_type == 'Hexbin' else False
-        interpolate = True if 'Blur' in plt_type else False
-        if 'Wasteland' in self.analyser.replay.header['MapName']:
-            arena = plotter.WASTELAND
+    def _figure(self, datasetname):
+        # Plots are only shown as images, a matplotlib figure is built when one is needed
+        plot = self.drawn_plots[datasetname].findChild(FigureImage)
+        if plot is None:
+            return None
+        heatmap = None
+        if not plot.settings['hexbin']:
+            heatmap = self._histogram(datasetname, plot.arena, plot.settings['bins'])
+        return plotter.generate_figure(self.datasets[datasetname], plot.arena, heatmap=heatmap,
+                                       **plot.settings)
+
+    def _arena(self, datasetname):
+        # Aggregated datasets bring their own arena, the others are from the loaded replay
+        arena = self.datasets[datasetname].get('arena')
+        if arena is None:
+            wasteland = 'Wasteland' in self.analyser.replay.header['MapName']
+            arena = plotter.WASTELAND if wasteland else plotter.STANDARD
+        if arena is plotter.WASTELAND:
             overlays = [plotter.OUTLINE, plotter.FIELDLINE]  # TODO MAKE OPTION IN GUI
         else:
-            arena = plotter.STANDARD
             overlays = [plotter.OUTLINE, plotter.FIELDLINE, plotter.BOOST]
+        return arena, overlays
+
+    def _bins(self, arena):
         scale = self.sld_res.value()/10
-        bins = (math.ceil(scale*15), math.ceil(scale*15*arena['aspect']))
+        return math.ceil(scale*15), math.ceil(scale*15*arena['aspect'])
+
+    def _histogram(self, datasetname, arena, bins):
+        # Coarser grids are block sums of a fine histogram binned once per dataset
+        # The lock only guards the cache, so workers may bin the same dataset concurrently
+        key = (datasetname, arena['name'], bins)
+        with self.histogram_lock:
+            histogram = self.histograms.get(key)
+            fine = self.histograms.get((datasetname, arena['name']))
+            generation = self.histogram_generation
+        if histogram is not None:
+            return histogram
+        data = self.datasets[datasetname]
+        if fine is None and 'fine' in data:
+            fine = data['fine']  # Summed over replays, see set_aggregate
+        elif fine is None:
+            fine = plotter.fine_histogram(plotter.bin_indices(data['x'], data['y'], arena))
+            self._put_histogram((datasetname, arena['name']), fine, generation)
+        histogram = plotter.reduce_histogram(fine, bins)
+        self._put_histogram(key, histogram, generation)
+        return histogram
+
+    def _put_histogram(self, key, histogram, generation):
+        with self.histogram_lock:
+            if generation == self.histogram_generation:
+                self.histograms.put(key, histogram)
+
+    def _clear_histograms(self):
+        with self.histogram_lock:
+            self.histograms.clear()
+            self.histogram_generation += 1
+
+    def _resize_bins(self):
+        # Histograms follow the slider live, other settings are applied with Update
+        if not self.heatmaps:
+            return
+        for datasetname, target in self.heatmaps.items():
+            arena, _ = self._arena(datasetname)
+            target.settings['bins'] = bins = self._bins(arena)
+            if isinstance(target, HeatmapThumbnail):
+                histogram = self._histogram(datasetname, arena, bins)
+                target.set_pixels(plotter.heatmap_rgba(histogram, target.settings['norm']))
+            else:
+                # The old image stays until the figure is rendered again
+                self._submit_plot(datasetname, target.settings, False)
+
+    def _generate_plot_widget(self, datasetname):
+        plt_type = self.cmb_style.currentText()
+        # Aggregated datasets have no points to hexbin
+        hexbin = plt_type == 'Hexbin' and 'fine' not in self.datasets[datasetname]
+        interpolate = True if 'Blur' in plt_type else False
+        arena, overlays = self._arena(datasetname)
+        bins = self._bins(arena)
         log = self.chk_logscale.isChecked()
-        plot = plotter.generate_figure(self.datasets[datasetname],
-                                       arena,
-                                       overlays=overlays,
-                                       bins=bins,
-                                       norm=log,
-                                       interpolate=interpolate,
-                                       hexbin=hexbin)
         size_min = QSize(280, arena['aspect']*280)
         size_max = QSize(650, arena['aspect']*650)
         frm = QFrame()
@@ -362,14 +488,71 @@ class HeatmapWidget(QWidget):
         frm.setPalette(palette)
         frml = QVBoxLayout(frm)
         frml.setContentsMargins(0, 0, 0, 0)
-        fig = FigureCanvas(plot)
-        fig.mpl_connect('scroll_event', lambda evt: self.scroll_area.verticalScrollBar().setValue(
-                self.scroll_area.verticalScrollBar().value()+int(evt.step)*-60))
-        fig.setContentsMargins(0, 0, 0, 0)
-        frml.addWidget(fig)
+        lbl_rendering = QLabel(frm)
+        lbl_rendering.setText('Rendering %s...' % datasetname)
+        lbl_rendering.setAlignment(Qt.AlignCenter)
+        frml.addWidget(lbl_rendering)
         self.drawn_plots[datasetname] = frm
+        self.heatmaps.pop(datasetname, None)
+
+        # The frame is a placeholder until the plot is rendered on the render pool
+        settings = dict(overlays=overlays, bins=bins, norm=log, interpolate=interpolate,
+                        hexbin=hexbin)
+        self._submit_plot(datasetname, settings, not hexbin and self.chk_thumbnails.isChecked())
         return frm
 
+    def _submit_plot(self, datasetname, settings, thumbnail):
+        arena, _ = self._arena(datasetname)
+        histogram = None
+        if not settings['hexbin']:
+            histogram = partial(self._histogram, datasetname, arena, settings['bins'])
+        self._cancel_job(datasetname)
+        stop = Event()
+        if thumbnail:
+            future = self.executor.submit(_render_thumbnail, histogram, stop, settings['norm'])
+        else:
+            # Figures are rasterized at the largest size of their frame and scaled down
+            size = self.drawn_plots[datasetname].maximumSize()
+            future = self.executor.submit(_render_plot, self.datasets[datasetname], arena,
+                                          histogram, stop, (size.width(), size.height()),
+                                          **settings)
+        self.jobs[datasetname] = (future, stop, settings, thumbnail)
+        future.add_done_callback(partial(self.emitter.finished.emit, datasetname))
+
+    def _cancel_job(self, datasetname):
+        job = self.jobs.pop(datasetname, None)
+        if job:
+            job[0].cancel()
+            job[1].set()
+
+    def _plot_finished(self, datasetname, future):
+        # Results of cancelled or replaced jobs are dropped
+        if self.jobs.get(datasetname, (None,))[0] is not future:
+            return
+        _, _, settings, thumbnail = self.jobs.pop(datasetname)
+        frm = self.drawn_plots[datasetname]
+        if future.exception():
+            self.logger.error('Failed to build heatmap %s: %s' % (datasetname, future.exception()))
+            lbl_rendering = frm.findChild(QLabel)
+            if lbl_rendering:
+                lbl_rendering.setText('Failed to build %s' % datasetname)
+            return
+        plot = frm.findChild(FigureImage)
+        if plot:
+            plot.set_pixels(future.result())  # Rendered again for new bins, see _resize_bins
+            return
+        arena, _ = self._arena(datasetname)
+        if thumbnail:
+            plot = HeatmapThumbnail(frm, self.datasets[datasetname]['title'], arena, settings,
+                                    future.result())
+        else:
+            plot = FigureImage(frm, arena, settings, future.result())
+        lbl_rendering = frm.findChild(QLabel)
+        frm.layout().replaceWidget(lbl_rendering, plot)
+        lbl_rendering.deleteLater()
+        if not settings['hexbin']:
+            self.heatmaps[datasetname] = plot
+
     def _highlight_plots(self):
         selected_plots = self.lst_plots.selectedItems()
         if selected_plots:
@@ -392,6 +575,96 @@ class HeatmapWidget(QWidget):
         self.btn_addplot.setEnabled(enable_add)
 
 
+class FigureImage(QWidget):
+    """Shows a figure rasterized on the render pool, scaled to the size of the widget.
+
+    Settings are kept so the figure can be built again for Popout and Save.
+    """
+
+    def __init__(self, parent, arena, settings, pixels):
+        super().__init__(parent)
+        self.arena = arena
+        self.settings = settings
+        self.image = None
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.set_pixels(pixels)
+
+    def set_pixels(self, pixels):
+        height, width = pixels.shape[:2]
+        self.image = QImage(pixels.data, width, height, 4 * width, QImage.Format_RGBA8888).copy()
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
+        painter.drawImage(self.rect(), self.image)
+        painter.end()
+
+
+class HeatmapThumbnail(FigureImage):
+    """Draws a colored histogram and the arena overlays as scaled images.
+
+    Scrolling and resizing only rescale two small images.
+    """
+
+    def __init__(self, parent, title, arena, settings, pixels):
+        super().__init__(parent, arena, settings, pixels)
+        self.title = title
+        self.overlay = _overlay_image(arena, settings['overlays'])
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(*plotter.BAD_COLOR))
+        title_height = painter.fontMetrics().height() + 6
+        field = self.rect().adjusted(0, title_height, 0, 0)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, self.settings['interpolate'])
+        painter.drawImage(field, self.image)
+        if self.overlay:
+            painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
+            painter.drawImage(field, self.overlay)
+        painter.setPen(Qt.white)
+        painter.drawText(QRect(0, 0, self.width(), title_height), Qt.AlignCenter, self.title)
+        painter.end()
+
+
+def _overlay_image(arena, overlays):
+    if not overlays:
+        return None
+    key = (arena['name'], tuple(overlays))
+    if key not in _overlay_images:
+        # Flipped like the figures, which show the overlays with origin='lower'
+        pixels = np.ascontiguousarray(
+            (plotter.overlay_image(arena, overlays)[::-1] * 255).round().astype(np.uint8))
+        height, width = pixels.shape[:2]
+        _overlay_images[key] = QImage(pixels.data, width, height, 4 * width,
+                                      QImage.Format_RGBA8888).copy()
+    return _overlay_images[key]
+
+
+class RenderEmitter(QObject):
+    # Hands finished render jobs from the pool threads to the GUI thread
+    finished = pyqtSignal(str, object)
+
+
+def _render_thumbnail(histogram, stop, norm):
+    heatmap = histogram()
+    if stop.is_set():
+        return None
+    return plotter.heatmap_rgba(heatmap, norm)
+
+
+def _render_plot(data, arena, histogram, stop, size, **settings):
+    heatmap = histogram() if histogram else None
+    if stop.is_set():
+        return None
+    fig = plotter.generate_figure(data, arena, heatmap=heatmap, **settings)
+    canvas = FigureCanvasAgg(fig)
+    fig.set_size_inches(size[0] / fig.dpi, size[1] / fig.dpi)
+    canvas.draw()
+    width, height = canvas.get_width_height()
+    return np.frombuffer(canvas.buffer_rgba(), np.uint8).reshape(height, width, 4).copy()
+
+
 class PopoutDialog(QDialog):
 
     def __init__(self, widget, title):
@@ -13,22 +13,25 @@ class MetadataWidget(QWidget):
         self.setEnabled(False)
         self.lst_meta = None  # Attribute List
         self.txt_meta = None  # TextWidget for Attribute Display
-        self.meta_attributes = None
+        self.replay = None
+        self.meta_attributes = None  # Displayed name -> replay attribute
         self._generate_widget()
 
     def set_replay(self, replay):
-        self.meta_attributes = OrderedDict([('CRC', replay.crc),
-                                            ('Version', replay.version),
-                                            ('Header', replay.header),
-                                            ('Maps', replay.maps),
-                                            ('KeyFrames', replay.keyframes),
-                                            ('Debug Log', replay.dbg_log),
-                                            ('Goal Frames', replay.goal_frames),
-                                            ('Packages', replay.packages),
-                                            ('Objects', replay.objects),
-                                            ('Names', replay.names),
-                                            ('Class Map', replay.class_index_map),
-                                            ('Netcache Tree', replay.netcache)])
+        # Attributes are only read once selected, saved replays load them on first access
+        self.replay = replay
+        self.meta_attributes = OrderedDict([('CRC', 'crc'),
+                                            ('Version', 'version'),
+                                            ('Header', 'header'),
+                                            ('Maps', 'maps'),
+                                            ('KeyFrames', 'keyframes'),
+                                            ('Debug Log', 'dbg_log'),
+                                            ('Goal Frames', 'goal_frames'),
+                                            ('Packages', 'packages'),
+                                            ('Objects', 'objects'),
+                                            ('Names', 'names'),
+                                            ('Class Map', 'class_index_map'),
+                                            ('Netcache Tree', 'netcache')])
         self.lst_meta.clear()
         self.lst_meta.addItems(self.meta_attributes.keys())
         self.setEnabled(True)
@@ -59,7 +62,7 @@ class MetadataWidget(QWidget):
 
     def _show_meta(self):
         item = self.lst_meta.currentItem()
-        data = self.meta_attributes[item.text()]
+        data = getattr(self.replay, self.meta_attributes[item.text()])
         if not data:
             data = "Empty Attribute"
         else:
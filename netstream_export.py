@@ -0,0 +1,55 @@
+import gzip
+import json
+import os
+
+PROGRESS_INTERVAL = 100  # Frames between two progress reports
+
+
+def export_netstream(netstream, filename, progress=None, stop=None):
+    """Writes the netstream to filename frame by frame instead of building one big string.
+
+    Files ending in .ndjson (optionally followed by .gz) get one JSON object per frame and
+    line, everything else a single object keyed by frame number. A .gz suffix compresses the
+    output. progress is called with the current frame number, setting stop aborts the export
+    and removes the incomplete file. The file is removed as well if writing fails.
+    """
+    compress = filename.endswith('.gz')
+    ndjson = filename[:-3 if compress else None].endswith('.ndjson')
+    opener = gzip.open if compress else open
+    try:
+        with opener(filename, 'wt', encoding='utf-8') as outfile:
+            if not ndjson:
+                outfile.write('{')
+            for n, i in enumerate(sorted(netstream)):
+                if stop is not None and stop.is_set():
+                    break
+                frame = json.dumps(netstream[i], default=_encode, ensure_ascii=False)
+                if ndjson:
+                    outfile.write('{"frame": %d, "data": %s}\n' % (i, frame))
+                else:
+                    outfile.write('%s"%d": %s' % (',' if n else '', i, frame))
+                if progress and not n % PROGRESS_INTERVAL:
+                    progress(i)
+            else:
+                if not ndjson:
+                    outfile.write('}')
+                return True
+    except Exception:
+        _remove(filename)
+        raise
+    _remove(filename)
+    return False
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+def _encode(obj):
+    # Frames and other pyrope objects are written as their attributes
+    try:
+        return vars(obj)
+    except TypeError:
+        return str(obj)
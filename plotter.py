@@ -9,7 +9,8 @@ from itertools import chain
 
 logger = logging.getLogger('pyrain')
 
-STANDARD = {'outline': {'file': 'resources/arena_outline.png',
+STANDARD = {'name': 'standard',
+            'outline': {'file': 'resources/arena_outline.png',
                         'alpha': 0.8},
             'fieldline': {'file': 'resources/arena_fieldlines.png',
                           'alpha': 0.3},
@@ -21,7 +22,8 @@ STANDARD = {'outline': {'file': 'resources/arena_outline.png',
             'ymax': 4096,
             'aspect': 0.71}
 
-WASTELAND = {'outline': {'file': 'resources/wasteland_outline.png',
+WASTELAND = {'name': 'wasteland',
+             'outline': {'file': 'resources/wasteland_outline.png',
                          'alpha': 0.8},
              'fieldline': {'file': 'resources/wasteland_fieldlines.png',
                            'alpha': 0.3},
@@ -31,6 +33,8 @@ WASTELAND = {'outline': {'file': 'resources/wasteland_outline.png',
              'ymax': 4530,
              'aspect': 0.76}
 
+ARENAS = {arena['name']: arena for arena in (STANDARD, WASTELAND)}
+
 BOOST = 'boost'
 OUTLINE = 'outline'
 FIELDLINE = 'fieldline'
@@ -41,30 +45,133 @@ FIELDLINE = 'fieldline'
 # Field length with goals: ~11540 aspect ratio: 0.71
 # bins for ~1:1 mapping:87x100x62
 
+# x/y bins of the finest histogram, the resolution slider tops out at 75 bins. Coarser grids are
+# block sums of it with edges snapped to the nearest fine bin (off by at most 1/16 of a bin)
+FINE_BINS = (600, 432)
+
+_overlays = {}  # (arena name, overlays) -> composited RGBA image, see overlay_image
+_luts = {}  # colormap name -> RGBA lookup table, see heatmap_rgba
+BAD_COLOR = (0, 0, 128, 255)  # Empty bins with logarithmic scaling, the figure background
+
 
 def graph_2d(values, mean=True):
     fig = plt.figure()
     ax = fig.add_subplot(111)
     ax.plot(values['xs'], values['ys'])
     if mean:
-        y_mean = [np.mean(values['ys']) for i in values['xs']]
-        ax.plot(values['xs'], y_mean, linestyle='--')
+        y_mean = np.mean(values['ys'])
+        ax.plot([values['xs'][0], values['xs'][-1]], [y_mean, y_mean], linestyle='--')
     plt.show()
 
 
-def lines2d(x, y, ax, mean=True):
+def lines2d(x, y, ax, mean=True, columns=None):
+    # With columns the line shows decimated data, see decimate
     lines = []
-    l, = ax.plot(x, y)
+    l, = ax.plot(*decimate(x, y, columns) if columns else (x, y))
     lines.append(l)
     if mean:
-        y_mean = [np.mean(y) for i in x]
-        l, = ax.plot(x, y_mean, linestyle='--')
+        y_mean = np.nanmean(y)
+        l, = ax.plot([x[0], x[-1]], [y_mean, y_mean], linestyle='--')
         lines.append(l)
     return lines
 
 
+def decimate(x, y, columns, xlim=None):
+    """Reduces a line to the minimum and maximum of y per display column.
+
+    x has to be sorted. Only points within xlim (and their direct neighbours, so the line reaches
+    the edges) are kept. Columns without any valid sample stay NaN, so gaps in the line survive.
+    """
+    lo, hi = 0, len(x)
+    if xlim is not None:
+        lo, hi = np.searchsorted(x, xlim)
+        lo, hi = max(lo - 1, 0), min(hi + 1, len(x))
+    x, y = x[lo:hi], y[lo:hi]
+    if len(x) <= 2 * columns:
+        return x, y
+    starts = np.unique(np.searchsorted(x, np.linspace(x[0], x[-1], columns + 1)[:-1]))
+    x_out = np.empty(2 * len(starts) + 1, dtype=x.dtype)
+    y_out = np.empty(2 * len(starts) + 1, dtype=np.result_type(y.dtype, np.float32))
+    x_out[:-1] = np.repeat(x[starts], 2)
+    y_out[:-1:2] = np.fmin.reduceat(y, starts)
+    y_out[1:-1:2] = np.fmax.reduceat(y, starts)
+    x_out[-1], y_out[-1] = x[-1], y[-1]
+    return x_out, y_out
+
+
+def bin_indices(x, y, arena, bins=FINE_BINS):
+    # Flat index of the bin every point falls into, points outside the arena are dropped
+    x = (np.asarray(x, dtype=np.float64) - arena['xmin']) / (arena['xmax'] - arena['xmin'])
+    y = (np.asarray(y, dtype=np.float64) - arena['ymin']) / (arena['ymax'] - arena['ymin'])
+    x *= bins[0]
+    y *= bins[1]
+    inside = (x >= 0) & (x <= bins[0]) & (y >= 0) & (y <= bins[1])
+    # Like np.histogram2d the upper edge belongs to the last bin
+    ix = np.minimum(x[inside].astype(np.intp), bins[0] - 1)
+    iy = np.minimum(y[inside].astype(np.intp), bins[1] - 1)
+    return iy * bins[0] + ix
+
+
+def fine_histogram(indices, bins=FINE_BINS):
+    # Integer counts with rows along y, the layout imshow expects
+    return np.bincount(indices, minlength=bins[0] * bins[1]).reshape(bins[1], bins[0])
+
+
+def reduce_histogram(fine, bins):
+    """Sums blocks of a fine histogram into bins=(x, y) bins."""
+    rows = np.rint(np.arange(bins[1]) * fine.shape[0] / bins[1]).astype(np.intp)
+    cols = np.rint(np.arange(bins[0]) * fine.shape[1] / bins[0]).astype(np.intp)
+    return np.add.reduceat(np.add.reduceat(fine, rows, axis=0), cols, axis=1)
+
+
+def overlay_image(arena, overlays):
+    """Composites the overlay PNGs of arena into a single RGBA image.
+
+    Images are decoded and blended once per arena and overlay combination. Layers of different
+    sizes are resampled to the largest one, they all cover the extent of the arena.
+    """
+    key = (arena['name'], tuple(overlays))
+    if key not in _overlays:
+        layers = [(plt.imread(arena[overlay]['file']), arena[overlay]['alpha'])
+                  for overlay in overlays]
+        height = max(im.shape[0] for im, _ in layers)
+        width = max(im.shape[1] for im, _ in layers)
+        color = np.zeros((height, width, 3), dtype=np.float32)  # Premultiplied by alpha
+        alpha = np.zeros((height, width, 1), dtype=np.float32)
+        for im, layer_alpha in layers:
+            im = im[np.arange(height) * im.shape[0] // height][:, np.arange(width) * im.shape[1]
+                                                               // width]
+            im_alpha = layer_alpha * (im[..., 3:] if im.shape[2] == 4 else np.ones_like(alpha))
+            color = im[..., :3] * im_alpha + color * (1 - im_alpha)
+            alpha = im_alpha + alpha * (1 - im_alpha)
+        color = np.divide(color, alpha, out=np.zeros_like(color), where=alpha > 0)
+        _overlays[key] = np.concatenate((color, alpha), axis=2)
+    return _overlays[key]
+
+
+def heatmap_rgba(heatmap, norm=False, cmap='jet'):
+    """Colors a histogram like generate_figure through a 256 entry lookup table.
+
+    Returns uint8 RGBA pixels with the first row at the top, ready to be wrapped in an image.
+    """
+    if cmap not in _luts:
+        _luts[cmap] = (plt.get_cmap(cmap)(np.linspace(0, 1, 256)) * 255).round().astype(np.uint8)
+    values = heatmap.astype(np.float64)
+    bad = values <= 0 if norm else np.zeros(values.shape, dtype=bool)
+    if norm:
+        values = np.log(values, out=np.zeros_like(values), where=~bad)
+    valid = values[~bad]
+    low, high = (valid.min(), valid.max()) if valid.size else (0, 0)
+    scaled = (values - low) / (high - low) if high > low else np.zeros_like(values)
+    pixels = _luts[cmap][np.clip((scaled * 256).astype(np.intp), 0, 255)]
+    pixels[bad] = BAD_COLOR
+    return np.ascontiguousarray(pixels[::-1])
+
+
 def generate_figure(data, arena, overlays=None, bins=(25, 12), hexbin=False, interpolate=True,
-                    norm=False):
+                    norm=False, heatmap=None):
+    # heatmap is an optional precomputed histogram (see reduce_histogram) used instead of binning
+    # the points of data again
     fig = Figure()
     ax = fig.add_subplot(111)
     x = data['x']
@@ -78,20 +185,16 @@ def generate_figure(data, arena, overlays=None, bins=(25, 12), hexbin=False, int
                                                                      arena['ymin'], arena['ymax']])
     else:
         interpolate = 'bilinear' if interpolate else 'none'
-        bins = (bins[1], bins[0])
-        heatmap, xedges, yedges = np.histogram2d(y, x, bins=bins,
-                                                 range=[(arena['ymin'], arena['ymax']),
-                                                        (arena['xmin'], arena['xmax'])])
-        extent = [yedges[0], yedges[-1], xedges[0], xedges[-1]]
+        if heatmap is None:
+            heatmap = fine_histogram(bin_indices(x, y, arena, bins), bins)
+        extent = [arena['xmin'], arena['xmax'], arena['ymin'], arena['ymax']]
         ax.imshow(heatmap, extent=extent, norm=norm, cmap=cmap, interpolation=interpolate,
-                  origin='lower', aspect='auto')
+                  origin='lower', aspect='auto', gid='heatmap')
         ax.autoscale(False)
     if overlays:
-        for overlay in overlays:
-            im = plt.imread(arena[overlay]['file'])
-            axi = ax.imshow(im, origin='lower', aspect='auto', alpha=arena[overlay]['alpha'],
-                            extent=[arena['xmin'], arena['xmax'], arena['ymin'], arena['ymax']])
-            axi.set_zorder(2)
+        axi = ax.imshow(overlay_image(arena, overlays), origin='lower', aspect='auto',
+                        extent=[arena['xmin'], arena['xmax'], arena['ymin'], arena['ymax']])
+        axi.set_zorder(2)
     ax.text(0.1, 0, 'Team 0',
             transform=ax.transAxes,
             bbox=dict(facecolor='white'))
@@ -0,0 +1,157 @@
+import json
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+from registry import ActorRegistry
+from trajectory import Trajectory
+
+MAGIC = b'PYRAIN'
+FORMAT_VERSION = 1
+ALIGN = 64  # Byte alignment of every array block
+META_ATTRIBUTES = ('crc', 'version', 'header', 'maps', 'keyframes', 'dbg_log', 'goal_frames',
+                   'packages', 'objects', 'names', 'class_index_map', 'netcache')
+EAGER_ATTRIBUTES = ('crc', 'version', 'header')  # Small sections read together with the file
+
+# File layout: MAGIC, format version (uint16), JSON length (uint64), JSON document, then the
+# JSON encoded metadata sections and the raw array blocks at the offsets listed in the document.
+_PREAMBLE = struct.Struct('<6sHQ')
+
+
+class SavedReplay:
+    """Replay read back from a .pyrain file. The netstream itself is not stored.
+
+    Metadata sections other than EAGER_ATTRIBUTES are only read from the file on first access,
+    the trajectory arrays once analyser_state is called.
+    """
+
+    def __init__(self, filename, doc):
+        self._filename = filename
+        self._doc = doc
+        self._state = None
+        self.netstream = None
+        for attr in EAGER_ATTRIBUTES:
+            setattr(self, attr, self._read_section(attr))
+
+    def __getattr__(self, attr):
+        # Only called for attributes that have not been loaded yet
+        if attr.startswith('_') or attr not in META_ATTRIBUTES:
+            raise AttributeError(attr)
+        value = self._read_section(attr)
+        setattr(self, attr, value)
+        return value
+
+    def __getstate__(self):
+        # Pickled copies carry all sections, the memory maps stay with the file
+        state = {attr: getattr(self, attr) for attr in META_ATTRIBUTES}
+        state['netstream'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def _read_section(self, attr):
+        entry = self._doc['sections'][attr]
+        with open(self._filename, 'rb') as infile:
+            infile.seek(entry['offset'])
+            return json.loads(infile.read(entry['length']).decode('utf-8'))
+
+    def metadata_to_json(self):
+        return json.dumps({attr: getattr(self, attr) for attr in META_ATTRIBUTES},
+                          indent=2, ensure_ascii=False)
+
+    def analyser_state(self):
+        """Analyser state stored in the file, with all arrays memory mapped read-only."""
+        if self._state is None:
+            doc = self._doc
+            arrays = {key: _memmap(self._filename, entry) for key, entry in doc['arrays'].items()}
+            saved = doc['analyser']
+            trajectories = {name: [Trajectory(*(arrays[t['arrays'][column]]
+                                                 for column in Trajectory.COLUMNS), end=t['end'])
+                                   for t in segments]
+                            for name, segments in saved['trajectories']}
+            self._state = {'maxframe': saved['maxframe'],
+                           'frame_times': arrays['frame_times'],
+                           'player_data': OrderedDict(saved['player_data']),
+                           'trajectories': trajectories,
+                           'registry': ActorRegistry.from_state(saved['registry'])}
+        return self._state
+
+
+def save(filename, replay, analyser):
+    sections = OrderedDict((attr, json.dumps(getattr(replay, attr, None),
+                                             ensure_ascii=False).encode('utf-8'))
+                           for attr in META_ATTRIBUTES)
+    arrays = OrderedDict()
+    arrays['frame_times'] = analyser.frame_times
+    trajectories = OrderedDict()
+    for name, segments in analyser.trajectories.items():
+        trajectories[name] = []
+        for trajectory in segments:
+            # Columns are separate blocks, so memory mapped positions are aligned and contiguous
+            keys = {}
+            for column in Trajectory.COLUMNS:
+                keys[column] = 'trajectory%d' % len(arrays)
+                arrays[keys[column]] = getattr(trajectory, column)
+            trajectories[name].append({'arrays': keys, 'end': trajectory.end})
+    doc = {'analyser': {'maxframe': int(analyser.maxframe),
+                        'player_data': list(analyser.player_data.items()),
+                        'registry': analyser.registry.get_state(),
+                        'trajectories': list(trajectories.items())}}
+    relative = OrderedDict()
+    offset = 0
+    for key, section in sections.items():
+        relative[key] = offset
+        offset += len(section)
+    offset = _aligned(offset)
+    for key, array in arrays.items():
+        relative[key] = offset
+        offset += _aligned(array.nbytes)
+    # Everything else follows the JSON document, whose length depends on the offsets in it
+    start = 0
+    while True:
+        doc['sections'] = {key: {'offset': start + relative[key], 'length': len(section)}
+                           for key, section in sections.items()}
+        doc['arrays'] = {key: {'offset': start + relative[key],
+                               'dtype': array.dtype.str,
+                               'shape': array.shape}
+                         for key, array in arrays.items()}
+        body = json.dumps(doc, ensure_ascii=False).encode('utf-8')
+        if _PREAMBLE.size + len(body) <= start:
+            break
+        start = _aligned(_PREAMBLE.size + len(body))
+    with open(filename, 'wb') as outfile:
+        outfile.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(body)))
+        outfile.write(body)
+        outfile.write(b'\0' * (start - outfile.tell()))
+        for section in sections.values():
+            outfile.write(section)
+        for key, array in arrays.items():
+            outfile.write(b'\0' * (doc['arrays'][key]['offset'] - outfile.tell()))
+            outfile.write(np.ascontiguousarray(array).tobytes())
+
+
+def load(filename):
+    """Reads the document of a .pyrain file and returns a SavedReplay for it."""
+    with open(filename, 'rb') as infile:
+        magic, version, length = _PREAMBLE.unpack(infile.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise TypeError('%s is not a pyrain file' % filename)
+        if version > FORMAT_VERSION:
+            raise TypeError('pyrain file version %d is not supported' % version)
+        doc = json.loads(infile.read(length).decode('utf-8'))
+    return SavedReplay(filename, doc)
+
+
+def _memmap(filename, entry):
+    shape = tuple(entry['shape'])
+    dtype = np.dtype(entry['dtype'])
+    if not np.prod(shape):
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=entry['offset'], shape=shape)
+
+
+def _aligned(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
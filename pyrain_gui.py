@@ -5,19 +5,24 @@ import sys
 import logging
 
 from os import path
-from queue import Queue
+from multiprocessing import freeze_support
+from queue import Queue, Empty
 from threading import Thread, Event
 from io import StringIO
-from time import sleep, time
+from time import time
 
 from PyQt5.QtCore import QSize, Qt, QRect, QThread, pyqtSignal
 from PyQt5.QtWidgets import (QSizePolicy, QWidget, QVBoxLayout, QTabWidget, QPlainTextEdit,
                              QLayout, QPushButton, QMenuBar, QMenu, QAction, QDialog, QApplication,
-                             QProgressBar, QMessageBox, QFileDialog, QMainWindow)
+                             QProgressBar, QMessageBox, QFileDialog, QMainWindow, QLabel)
 
+import pyrain_file
+from aggregate import HistogramAggregate, process_replays
+from netstream_export import export_netstream
 from analyser import Analyser
 from distance_widget import DistanceWidget
 from qt_ext import QtHandler
+from replay_cache import ReplayCache
 from heatmap_widget import HeatmapWidget
 from metadata_widget import MetadataWidget
 from pyrope import Replay
@@ -29,6 +34,9 @@ class PyRainGui(QMainWindow):
         super().__init__()
         self.replay = None
         self.analyser = None
+        self.pending_state = None  # Builds the Analyser state once an analysis tab is shown
+        self.cache = ReplayCache()
+        self.aggregate = HistogramAggregate()  # Heatmap counts of all aggregated replays
         self.setup_ui()
         handler = QtHandler(self.txt_log)
         handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
@@ -54,6 +62,8 @@ class PyRainGui(QMainWindow):
 
         tabview = QTabWidget(self.centralwidget)
         tabview.setTabPosition(QTabWidget.North)
+        tabview.currentChanged.connect(self.tab_changed)
+        self.tabview = tabview
 
         self.meta_tab = MetadataWidget(parent=tabview)
         tabview.addTab(self.meta_tab, "MetaData")
@@ -93,6 +103,10 @@ class PyRainGui(QMainWindow):
         action_export.setText('Export...')
         menu_file.addAction(action_export)
 
+        action_aggregate = QAction(self)
+        action_aggregate.setText('Aggregate Replays...')
+        menu_file.addAction(action_aggregate)
+
         action_exit = QAction(self)
         action_exit.setText('Exit')
         menu_file.addAction(action_exit)
@@ -109,6 +123,7 @@ class PyRainGui(QMainWindow):
         action_exit.triggered.connect(self.close)
         action_toggle_log.triggered.connect(self.toggle_log)
         action_export.triggered.connect(self.export_data)
+        action_aggregate.triggered.connect(self.aggregate_replays)
         self.setMenuBar(menubar)
 
     def export_data(self):
@@ -116,10 +131,23 @@ class PyRainGui(QMainWindow):
             logger.error("Nothing to Export")
             return
         folder = path.dirname(path.realpath(__file__))
-        ext = 'Replay (*.pyrope);;MetaData (*.json);;Header (*.json);;Netstream (*.json)'
+        ext = ('Replay (*.pyrope);;PyRain (*.pyrain);;MetaData (*.json);;Header (*.json);;'
+               'Netstream (*.json *.json.gz);;Netstream NDJSON (*.ndjson *.ndjson.gz)')
         filename = QFileDialog.getSaveFileName(self, 'Export Replay', folder, ext)
         if filename[0]:
-            if 'Replay' in filename[1]:
+            if 'PyRain' in filename[1]:
+                if self.pending_state:
+                    self.load_analyser()
+                if not self.analyser:
+                    logger.error('Netstream not parsed')
+                    return
+                source = getattr(self.replay, '_filename', None)
+                if source and path.realpath(source) == path.realpath(filename[0]):
+                    # The arrays of the loaded replay are memory mapped from that file
+                    logger.error('Cannot overwrite the pyrain file the replay was loaded from')
+                    return
+                pyrain_file.save(filename[0], self.replay, self.analyser)
+            elif 'Replay' in filename[1]:
                 pickle.dump(self.replay, open(filename[0], 'wb'), protocol=-1)
             elif 'MetaData' in filename[1]:
                 with open(filename[0], 'w', encoding='utf-8') as outfile:
@@ -131,25 +159,34 @@ class PyRainGui(QMainWindow):
                 if not self.replay.netstream:
                     logger.error('Netstream not parsed')
                     return
-                with open(filename[0], 'w', encoding='utf-8') as outfile:
-                    outfile.write(self.replay.netstream_to_json())
+                self.show_export_progress(filename[0])
 
     def toggle_log(self):
         self.txt_log.setVisible(not self.txt_log.isVisible())
 
-    def import_data(self):
+    def replay_folder(self):
         home = path.expanduser('~')
         replay_folder = home+'\\Documents\\My Games\\\Rocket League\\TAGame\\Demos'
         # replay_folder = path.dirname(path.realpath(__file__))+'\\testfiles'
         if not path.isdir(replay_folder):
             replay_folder = home
-        ext = 'Replay (*.pyrope *.replay)'
-        fname = QFileDialog.getOpenFileName(self, 'Load Replay', replay_folder, ext)
+        return replay_folder
+
+    def import_data(self):
+        ext = 'Replay (*.pyrope *.pyrain *.replay)'
+        fname = QFileDialog.getOpenFileName(self, 'Load Replay', self.replay_folder(), ext)
         if fname[0]:
             ext = fname[0].split('.')[-1]
             if ext == 'replay':
-                self.replay = Replay(path=fname[0])
+                self.set_replay(Replay(path=fname[0]))
                 logger.info('Rocket League Replay File loaded and Validated')
+                cached = self.cache.load(self.replay.crc)
+                if cached:
+                    self.replay = cached
+                    logger.info('Decoded Netstream restored from cache')
+                    self.netstream_loaded()
+                    self.meta_tab.set_replay(self.replay)
+                    return
                 msg = 'Header Parsed. Decode Netstream now?\n(This might take a while)'
                 question = QMessageBox().question(self, 'Proceed', msg,
                                                   QMessageBox.Yes, QMessageBox.No)
@@ -159,29 +196,98 @@ class PyRainGui(QMainWindow):
                     logger.warn('Netstream not Parsed. Only Metadata for view available')
             elif ext == 'pyrope':
                 # start = time()
-                self.replay = pickle.load(open(fname[0], 'rb'))
+                self.set_replay(pickle.load(open(fname[0], 'rb')))
                 # print("UNPICKLING: %f" % (time()-start))
                 logger.info('pyrain Parsed Replay File sucessfully loaded')
                 self.netstream_loaded()
+            elif ext == 'pyrain':
+                self.set_replay(pyrain_file.load(fname[0]))
+                logger.info('pyrain Replay File sucessfully loaded')
+                self.netstream_loaded(self.replay.analyser_state)
             self.meta_tab.set_replay(self.replay)
 
+    def set_replay(self, replay):
+        # Nothing extracted from the previous replay may be combined with the new one
+        self.replay = replay
+        self.analyser = None
+        self.pending_state = None
+        self.heatmap_tab.set_analyser(None)
+        self.distance_tab.set_analyser(None)
+
+    def aggregate_replays(self):
+        # Replays are merged into the running aggregate, known matches are skipped
+        fnames = QFileDialog.getOpenFileNames(self, 'Aggregate Replays', self.replay_folder(),
+                                              'Replay (*.replay)')[0]
+        if not fnames:
+            return
+        progress = ProgressDialog(self, len(fnames), 'Aggregating Replays',
+                                  'Processed %v/%m Replays', unit='replays')
+        ta = ThreadedAggregate(self, self.aggregate, fnames)
+        ta.progress.connect(progress.set_value)
+        ta.done.connect(lambda: [progress.close(), self.aggregate_loaded()])
+        progress.btn_cancel.clicked.connect(ta.setstop)
+        progress.show()
+        ta.start()
+
+    def aggregate_loaded(self):
+        self.heatmap_tab.set_aggregate(self.aggregate)
+        self.tabview.setCurrentWidget(self.heatmap_tab)
+        logger.info('%d Replays aggregated' % len(self.aggregate))
+
     def show_progress(self):
         num_frames = self.replay.header['NumFrames']-1
         progress = ProgressDialog(self, num_frames)
         ti = ThreadedImport(self, self.replay)
         ti.progress.connect(progress.set_value)
-        ti.done.connect(self.netstream_loaded)
+        ti.done.connect(lambda: [progress.close(), self.netstream_decoded()])
         ti.exception.connect(lambda e: [progress.close(), self.netstream_error(e)])
         progress.btn_cancel.clicked.connect(ti.setstop)
         progress.show()
         ti.start()
 
+    def show_export_progress(self, filename):
+        num_frames = max(self.replay.netstream, key=int)
+        progress = ProgressDialog(self, num_frames, 'Exporting Netstream',
+                                  'Exporting Netstream %p%')
+        te = ThreadedExport(self, self.replay.netstream, filename)
+        te.progress.connect(progress.set_value)
+        te.done.connect(lambda: [progress.close(), logger.info('Netstream exported')])
+        te.exception.connect(lambda e: [progress.close(), self.netstream_error(e)])
+        progress.btn_cancel.clicked.connect(te.setstop)
+        progress.show()
+        te.start()
+
     def netstream_error(self, exc):
         raise exc
 
-    def netstream_loaded(self):
+    def netstream_decoded(self):
+        Thread(target=self.cache.store, args=(self.replay.crc, self.replay)).start()
+        self.netstream_loaded()
+
+    def netstream_loaded(self, load_state=None):
+        # Analysis is deferred until the Heatmaps or Distances tab is opened
+        self.analyser = None
+        if not load_state:
+            load_state = lambda: self.cache.load(self.replay.crc, 'analyser')
+        self.pending_state = load_state
+        if self.tabview.currentWidget() in (self.heatmap_tab, self.distance_tab):
+            self.load_analyser()
+        logger.info('Netstream Parsed. No Errors found')
+
+    def tab_changed(self, index):
+        if self.pending_state and self.tabview.widget(index) in (self.heatmap_tab,
+                                                                 self.distance_tab):
+            self.load_analyser()
+
+    def load_analyser(self):
         # start = time()
-        analyser = Analyser(self.replay)
+        state = self.pending_state()
+        self.pending_state = None
+        analyser = Analyser(self.replay, state=state)
+        self.analyser = analyser
+        if state is None:
+            Thread(target=self.cache.store,
+                   args=(self.replay.crc, analyser.get_state(), 'analyser')).start()
         # print("analyser: %f" % (time()-start))
         # start = time()
         self.heatmap_tab.set_analyser(analyser)
@@ -189,30 +295,36 @@ class PyRainGui(QMainWindow):
         # start = time()
         self.distance_tab.set_analyser(analyser)
         # print("distance: %f" % (time()-start))
-        logger.info('Netstream Parsed. No Errors found')
 
 
 class ProgressDialog(QDialog):
 
-    def __init__(self, parent, limit):
+    def __init__(self, parent, limit, title='Parsing Replay', text='Parsing Netstream %p%',
+                 unit='frames'):
         super().__init__(parent)
         self.setWindowModality(Qt.ApplicationModal)
-        self.setWindowTitle('Parsing Replay')
-        self.setMinimumSize(QSize(400, 75))
-        self.setMaximumSize(QSize(400, 75))
+        self.setWindowTitle(title)
+        self.setMinimumSize(QSize(400, 95))
+        self.setMaximumSize(QSize(400, 95))
         vlayout = QVBoxLayout(self)
         vlayout.setSizeConstraint(QLayout.SetMinAndMaxSize)
 
         self.pbar = QProgressBar(self)
         self.pbar.setRange(0, limit)
         self.pbar.setAlignment(Qt.AlignCenter)
-        self.pbar.setFormat("Parsing Netstream %p%")
+        self.pbar.setFormat(text)
         self.pbar.setMinimumSize(QSize(380, 20))
         self.pbar.setMaximumSize(QSize(380, 20))
         size_policy = QSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
         self.pbar.setSizePolicy(size_policy)
         vlayout.addWidget(self.pbar)
 
+        self.unit = unit
+        self.lbl_rate = QLabel(self)
+        self.lbl_rate.setAlignment(Qt.AlignCenter)
+        vlayout.addWidget(self.lbl_rate)
+        self.start_time = time()
+
         self.btn_cancel = QPushButton(self)
         self.btn_cancel.setSizePolicy(size_policy)
         self.btn_cancel.setMinimumSize(QSize(120, 23))
@@ -226,11 +338,18 @@ class ProgressDialog(QDialog):
 
     def set_value(self, value):
         self.pbar.setProperty("value", value)
+        elapsed = time() - self.start_time
+        if value and elapsed:
+            rate = value / elapsed
+            eta = (self.pbar.maximum() - value) / rate
+            self.lbl_rate.setText("%s %s/s - %ds remaining" %
+                                  ('%d' % rate if rate >= 10 else '%.1f' % rate, self.unit, eta))
         if value == self.pbar.maximum():
             self.close()
 
 
 class ThreadedImport(QThread):
+    REFRESH_INTERVAL = 0.05  # Minimum seconds between two progress signals
     progress = pyqtSignal(int)
     done = pyqtSignal()
     exception = pyqtSignal(Exception)
@@ -244,20 +363,73 @@ class ThreadedImport(QThread):
         qout = Queue()
         parse_thread = Thread(target=self.replay.parse_netstream, args=(qout, self.stop))
         parse_thread.start()
+        latest = None  # Newest progress not yet sent to the GUI
+        last_emit = 0
         while not self.stop.isSet():
-            if qout.empty():
-                sleep(0.1)
-                continue
-            msg = qout.get()
+            try:
+                msg = qout.get(timeout=self.REFRESH_INTERVAL)
+            except Empty:
+                msg = None
             if msg == 'done':
+                if latest is not None:
+                    self.progress.emit(latest)
                 self.done.emit()
                 return
             elif msg == 'exception':
                 exc = qout.get()
                 self.exception.emit(exc)
                 return
-            else:
-                self.progress.emit(msg)
+            elif msg is not None:
+                latest = msg
+            if latest is not None and time() - last_emit >= self.REFRESH_INTERVAL:
+                self.progress.emit(latest)
+                last_emit = time()
+                latest = None
+
+    def setstop(self):
+        self.stop.set()
+
+
+class ThreadedExport(QThread):
+    progress = pyqtSignal(int)
+    done = pyqtSignal()
+    exception = pyqtSignal(Exception)
+
+    def __init__(self, parent, netstream, filename):
+        QThread.__init__(self, parent)
+        self.netstream = netstream
+        self.filename = filename
+        self.stop = Event()
+
+    def run(self):
+        try:
+            if export_netstream(self.netstream, self.filename, self.progress.emit, self.stop):
+                self.done.emit()
+        except Exception as e:
+            self.exception.emit(e)
+
+    def setstop(self):
+        self.stop.set()
+
+
+class ThreadedAggregate(QThread):
+    progress = pyqtSignal(int)
+    done = pyqtSignal()
+
+    def __init__(self, parent, aggregate, paths):
+        QThread.__init__(self, parent)
+        self.aggregate = aggregate
+        self.paths = paths
+        self.stop = Event()
+
+    def run(self):
+        # Replays are decoded on a process pool and merged here as they finish
+        results = process_replays(self.paths, self.stop)
+        for processed, (_, result, _) in enumerate(results, 1):
+            if result is not None:
+                self.aggregate.merge(result)
+            self.progress.emit(processed)
+        self.done.emit()
 
     def setstop(self):
         self.stop.set()
@@ -286,9 +458,13 @@ def excepthook(exc_type, exc_value, tracebackobj):
     errorbox.setText(str(notice)+str(msg))
     errorbox.exec_()
 
-sys.excepthook = excepthook
 logger = logging.getLogger('pyrain')
-app = QApplication(sys.argv)
-ui = PyRainGui()
-ui.show()
-sys.exit(app.exec_())
+
+if __name__ == '__main__':
+    # Guarded so worker processes of the replay aggregation do not start another GUI
+    freeze_support()
+    sys.excepthook = excepthook
+    app = QApplication(sys.argv)
+    ui = PyRainGui()
+    ui.show()
+    sys.exit(app.exec_())
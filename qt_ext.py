@@ -1,12 +1,21 @@
 import logging
-from PyQt5.QtWidgets import QLayout, QSizePolicy
-from PyQt5.QtCore import Qt, QRect, QSize
+from PyQt5.QtWidgets import QLayout, QSizePolicy, QAbstractScrollArea
+from PyQt5.QtCore import Qt, QRect, QSize, QPoint, QObject, QTimer, pyqtSignal
 
 
 class FlowLayout(QLayout):
-    # TODO SHIT GETS LAGGY WITH LOTS OF MPL Figures
-    # Possible Solution: Resize only after resize event is done and not immediately
-    def __init__(self, parent=None, container=None, resize_threshold=(0, 0), margin=0, spacing=-1):
+    """Flows widgets into rows, sizing them to the container up to their maximum size.
+
+    With deferred=True resizes are applied once they settle for RESIZE_DELAY ms and widgets
+    outside the viewport of a scrolling container are hidden, so they skip painting and resize
+    handling until they are scrolled into view.
+    """
+
+    RESIZE_DELAY = 150
+    PREFETCH = 0.5  # Viewport heights above and below the viewport that are kept shown
+
+    def __init__(self, parent=None, container=None, resize_threshold=(0, 0), margin=0, spacing=-1,
+                 deferred=False):
         super(FlowLayout, self).__init__(parent)
         if parent is not None:
             self.setContentsMargins(margin, margin, margin, margin)
@@ -16,18 +25,31 @@ class FlowLayout(QLayout):
         if container:
             self.container = container
         self.resize_threshold = resize_threshold
+        self.deferred = deferred
+        self._geometries = {}  # (rect, container size) -> (item rects, height)
+        self._applied = None  # Rect the items were last laid out in
+        self._rects = []  # Item rects of the last layout
+        self._pending = None  # Rect waiting for the resize to settle
+        self._culled = set()  # Widgets hidden because they are outside the viewport
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._apply_pending)
+        if deferred and isinstance(self.container, QAbstractScrollArea):
+            self.container.verticalScrollBar().valueChanged.connect(self._cull)
 
     def __del__(self):
-        item = self.takeAt(0)
-        while item:
-            item = self.takeAt(0)
+        # The C++ layout may already be gone, so the items are dropped without invalidating it
+        del self.itemList[:]
+        self._culled.clear()
 
     def insertWidgetAt(self, index, widget):
         self.addWidget(widget)
         self.itemList.insert(index, self.itemList.pop(-1))
+        self._items_changed()
 
     def addItem(self, item):
         self.itemList.append(item)
+        self._items_changed()
 
     def count(self):
         return len(self.itemList)
@@ -39,9 +61,19 @@ class FlowLayout(QLayout):
 
     def takeAt(self, index):
         if 0 <= index < len(self.itemList):
-            return self.itemList.pop(index)
+            item = self.itemList.pop(index)
+            self._culled.discard(item.widget())
+            self._items_changed()
+            return item
         return None
 
+    def _items_changed(self):
+        # Cached geometries are stale and the next layout is applied right away
+        self._geometries.clear()
+        self._applied = None
+        self._rects = []
+        self.invalidate()
+
     def expandingDirections(self):
         return Qt.Orientations(Qt.Orientation(0))
 
@@ -49,12 +81,16 @@ class FlowLayout(QLayout):
         return True
 
     def heightForWidth(self, width):
-        height = self.do_layout(QRect(0, 0, width, 0), True)
-        return height
+        return self.calc_geometry(QRect(0, 0, width, 0))[1]
 
     def setGeometry(self, rect):
         super(FlowLayout, self).setGeometry(rect)
-        self.do_layout(rect, False)
+        if self.deferred and self._applied is not None and rect != self._applied:
+            # Wait for the drag to settle, items keep their geometry until then
+            self._pending = QRect(rect)
+            self._timer.start(self.RESIZE_DELAY)
+            return
+        self.do_layout(rect)
 
     def sizeHint(self):
         return self.minimumSize()
@@ -67,11 +103,38 @@ class FlowLayout(QLayout):
         size += QSize(2 * margin, 2 * margin)
         return size
 
-    def do_layout(self, rect, testonly):
+    def _apply_pending(self):
+        if self._pending is not None:
+            self.do_layout(self._pending)
+            self._pending = None
+
+    def do_layout(self, rect):
+        rects, height = self.calc_geometry(rect)
+        for item, item_rect in zip(self.itemList, rects):
+            if item.widget() in self._culled:
+                # Layout items skip hidden widgets, the widget resizes once it is shown again
+                item.widget().setGeometry(item_rect)
+            elif item.geometry() != item_rect:
+                item.setGeometry(item_rect)
+        self._applied = QRect(rect)
+        self._rects = rects
+        if self.deferred:
+            self._cull()
+        return height
+
+    def calc_geometry(self, rect):
+        # Item rects only depend on the rect and the container size, so they are cached
+        cont_width = self.container.geometry().width()+self.resize_threshold[0]
+        cont_height = self.container.geometry().height()+self.resize_threshold[1]
+        key = (rect.x(), rect.y(), rect.width(), cont_width, cont_height)
+        if key in self._geometries:
+            return self._geometries[key]
+
         x = rect.x()
         y = rect.y()
+        right = rect.x() + rect.width() - 1
         line_height = 0
-
+        rects = []
         for item in self.itemList:
             wid = item.widget()
             space_x = self.spacing() + wid.style().layoutSpacing(QSizePolicy.PushButton,
@@ -80,14 +143,7 @@ class FlowLayout(QLayout):
             space_y = self.spacing() + wid.style().layoutSpacing(QSizePolicy.PushButton,
                                                                  QSizePolicy.PushButton,
                                                                  Qt.Vertical)
-            next_x = x + item.geometry().width() + space_x
-            cont_width = self.container.geometry().width()+self.resize_threshold[0]
-            cont_height = self.container.geometry().height()+self.resize_threshold[1]
-            if next_x - space_x > rect.right() and line_height > 0:
-                x = rect.x()
-                y = y + line_height + space_y
-                next_x = x + item.geometry().width() + space_x
-                line_height = 0
+            size = item.geometry().size()
             max_height = item.maximumSize().height()
             max_width = item.maximumSize().width()
             if max_width or max_height:
@@ -95,14 +151,41 @@ class FlowLayout(QLayout):
                 scale_height = max_height/max_width
                 adjust_height = cont_width*scale_height >= cont_height
                 if cont_width >= max_width and cont_height >= max_height:
-                    item.setGeometry(QRect(x, y, max_width, max_height))
+                    size = QSize(max_width, max_height)
                 elif adjust_height and cont_height <= max_height:
-                    item.setGeometry(QRect(x, y, scale_width*cont_height, cont_height))
+                    size = QSize(int(scale_width*cont_height), cont_height)
                 else:
-                    item.setGeometry(QRect(x, y, cont_width, scale_height*cont_width))
-            x = next_x
-            line_height = max(line_height, item.geometry().height())
-        return y + line_height - rect.y()
+                    size = QSize(cont_width, int(scale_height*cont_width))
+            if x + size.width() > right and line_height > 0:
+                x = rect.x()
+                y = y + line_height + space_y
+                line_height = 0
+            rects.append(QRect(QPoint(x, y), size))
+            x = x + size.width() + space_x
+            line_height = max(line_height, size.height())
+
+        if len(self._geometries) > 16:
+            self._geometries.clear()
+        self._geometries[key] = (rects, y + line_height - rect.y())
+        return self._geometries[key]
+
+    def _cull(self):
+        # Only widgets near the viewport stay shown, the others skip painting while hidden
+        if not isinstance(self.container, QAbstractScrollArea) or self.parentWidget() is None:
+            return
+        viewport = self.container.viewport()
+        prefetch = int(viewport.height() * self.PREFETCH)
+        visible = QRect(self.parentWidget().mapFrom(viewport, QPoint(0, 0)), viewport.size())
+        visible.adjust(0, -prefetch, 0, prefetch)
+        for item, item_rect in zip(self.itemList, self._rects):
+            wid = item.widget()
+            shown = item_rect.intersects(visible)
+            if shown and wid in self._culled:
+                self._culled.discard(wid)
+                wid.show()
+            elif not shown and wid not in self._culled:
+                self._culled.add(wid)
+                wid.hide()
 
 
 class QtHandler(logging.Handler):
@@ -110,7 +193,14 @@ class QtHandler(logging.Handler):
     def __init__(self, widget):
         super().__init__()
         self.widget = widget
+        # Records are passed through a signal so background threads can log safely
+        self.emitter = LogEmitter()
+        self.emitter.message.connect(self.widget.appendPlainText)
 
     def emit(self, record):
         # record = self.format(record)
-        self.widget.appendPlainText(record.msg)
\ No newline at end of file
+        self.emitter.message.emit(record.msg)
+
+
+class LogEmitter(QObject):
+    message = pyqtSignal(str)
\ No newline at end of file
@@ -0,0 +1,69 @@
+PRI = 0
+CAR = 1
+BALL = 2
+BOOST = 3
+GAMEEVENT = 4
+TEAM = 5
+OTHER = 6
+
+PRI_KEY = 'e_Default__PRI_TA'  # PRIs are recognised by their key in the frame actors
+
+# Substrings of the actor type that identify a class, checked in order
+CLASS_PATTERNS = (('Car_Default', CAR),
+                  ('Ball_Default', BALL),
+                  ('CarComponent_Boost', BOOST),
+                  ('GameEvent', GAMEEVENT),
+                  ('Teams.Team', TEAM))
+
+
+class ActorRegistry:
+    """Maps actors to class ids once at spawn and tracks the car currently owned by each PRI."""
+
+    def __init__(self):
+        self.classes = {}  # actor id -> class id of the currently spawned actor
+        self.teams = {}  # team actor id -> team number
+        self._type_classes = {}  # actor type -> class id
+        self._spawned = {}  # frame actor key -> (actor id, class id)
+        self._owner = {}  # PRI actor id -> current car actor id
+
+    def get_state(self):
+        # JSON compatible state, see from_state. Ownership is only needed during extraction
+        return {'classes': list(self.classes.items()),
+                'teams': list(self.teams.items())}
+
+    @classmethod
+    def from_state(cls, state):
+        registry = cls()
+        registry.classes = dict(state['classes'])
+        registry.teams = dict(state['teams'])
+        return registry
+
+    def classify(self, actor_type):
+        try:
+            return self._type_classes[actor_type]
+        except KeyError:
+            cls = next((c for pattern, c in CLASS_PATTERNS if pattern in actor_type), OTHER)
+            self._type_classes[actor_type] = cls
+            return cls
+
+    def spawn(self, key, actor):
+        # The key of an actor changes with its type, so a reused actor id gets classified again
+        try:
+            return self._spawned[key]
+        except KeyError:
+            cls = PRI if PRI_KEY in key else self.classify(actor['actor_type'])
+            entry = (actor['actor_id'], cls)
+            self._spawned[key] = entry
+            self.classes[entry[0]] = entry[1]
+            if cls == TEAM and actor['actor_type'][-1].isdigit():
+                self.teams[entry[0]] = int(actor['actor_type'][-1])
+            return entry
+
+    def set_owner(self, pri, car):
+        self._owner[pri] = car
+
+    def owner(self, pri):
+        return self._owner.get(pri)
+
+    def team_number(self, actorid):
+        return self.teams.get(actorid)
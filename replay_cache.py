@@ -0,0 +1,88 @@
+import logging
+import os
+import pickle
+from os import path
+from threading import Lock
+
+logger = logging.getLogger('pyrain')
+
+CACHE_VERSION = 2  # Bump whenever the layout of cached objects changes
+CACHE_DIR = path.join(path.expanduser('~'), '.pyrain', 'cache')
+CACHE_SIZE = 2 * 2**30
+
+
+class ReplayCache:
+    """On-disk cache of decoded replays and derived data, keyed by replay CRC.
+
+    Every entry is one pickle file; its modification time doubles as last access time so the
+    least recently used files are evicted once the folder grows beyond max_bytes.
+    """
+
+    def __init__(self, folder=CACHE_DIR, max_bytes=CACHE_SIZE):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()  # Entries are stored from background threads
+
+    def _path(self, crc, kind):
+        return path.join(self.folder, '%s-v%d.%s' % (crc, CACHE_VERSION, kind))
+
+    def load(self, crc, kind='replay'):
+        filename = self._path(crc, kind)
+        try:
+            with open(filename, 'rb') as infile:
+                obj = pickle.load(infile)
+        except FileNotFoundError:
+            self.misses += 1
+            logger.debug("Cache miss for %s %s (%d hits, %d misses)" %
+                         (kind, crc, self.hits, self.misses))
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            logger.warning("Dropping unreadable cache entry %s" % filename)
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            return None
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            pass  # Evicted by another process after it was read
+        self.hits += 1
+        logger.info("Cache hit for %s %s (%d hits, %d misses)" %
+                    (kind, crc, self.hits, self.misses))
+        return obj
+
+    def store(self, crc, obj, kind='replay'):
+        os.makedirs(self.folder, exist_ok=True)
+        filename = self._path(crc, kind)
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmpname, 'wb') as outfile:
+            pickle.dump(obj, outfile, protocol=-1)
+        os.replace(tmpname, filename)
+        logger.debug("Stored %s %s in cache" % (kind, crc))
+        with self._lock:
+            self.evict()
+
+    def evict(self):
+        # Other processes may store and evict entries concurrently (see aggregate.py)
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(path.join(self.folder, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.debug("Evicted %s from cache" % name)
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class Trajectory:
+    """Positions of a single actor, one sample per frame, kept as one array per column.
+
+    Frames without a replicated position repeat the previous one. Slicing returns views on the
+    same arrays, so cutting a trajectory into goal segments does not copy any samples, and
+    reading the positions does not touch the frame numbers and times.
+    """
+
+    __slots__ = ('frame', 'time', 'pos', 'end')
+    COLUMNS = ('frame', 'time', 'pos')
+
+    def __init__(self, frame, time, pos, end=None):
+        self.frame = frame
+        self.time = time
+        self.pos = pos
+        if end is None and len(frame):
+            end = int(frame[-1])
+        self.end = end
+
+    @classmethod
+    def from_samples(cls, frames, times, positions, end=None):
+        return cls(np.asarray(frames, dtype=np.int32), np.asarray(times, dtype=np.float32),
+                   np.asarray(positions, dtype=np.float32).reshape(-1, 3), end)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            raise TypeError('Trajectories can only be sliced')
+        return Trajectory(self.frame[item], self.time[item], self.pos[item], self.end)
+
+    @property
+    def x(self):
+        return self.pos[:, 0]
+
+    @property
+    def y(self):
+        return self.pos[:, 1]
+
+    @property
+    def z(self):
+        return self.pos[:, 2]
+
+    @property
+    def start(self):
+        return int(self.frame[0]) if len(self.frame) else None
+
+    @property
+    def nbytes(self):
+        return self.frame.nbytes + self.time.nbytes + self.pos.nbytes
+
+    def slice_frames(self, start, end):
+        # View on all samples with start <= frame < end
+        lo, hi = np.searchsorted(self.frame, (start, end))
+        return self[lo:hi]